@@ -0,0 +1,224 @@
+"""
+Offline routing benchmark: tarmoq va BOT_TOKEN kerak emas.
+
+    python bench.py                 # default: har ssenariy 2000 post
+    python bench.py -n 500 --latency 0.002
+
+guess_topic_key, send_to_group_with_media va flush_album sintetik Message'lar
+bilan, chaqiruvlarni yozib oluvchi soxta bot orqali o'lchanadi.
+"""
+import os
+import sys
+import time
+import random
+import asyncio
+import logging
+import argparse
+import tracemalloc
+from types import SimpleNamespace
+
+os.environ.setdefault("SOURCE_CHAT_ID", "-1001000000001")
+os.environ.setdefault("DEST_CHAT_ID", "-1001000000002")
+
+from telegram import Message  # noqa: E402
+
+import bot  # noqa: E402
+
+logging.getLogger("channel_to_group").setLevel(logging.ERROR)
+
+WORDS = [w for ws in bot.DEFAULT_KEYWORDS.values() for w in ws] + [
+    "assalomu", "alaykum", "bugun", "ertaga", "kerak", "bor", "qancha", "iltimos", "aka", "opa",
+]
+NOISE = ["", "", "ga", "lar", "dan", "ni"]
+
+
+# ============ FAKE BOT ============
+class FakeBot:
+    """Har qanday Bot API metodini qabul qiladi va chaqiruvni yozib qo'yadi."""
+
+    def __init__(self, latency: float = 0.0):
+        self.latency = latency
+        self.calls = []
+        self._next_id = 1
+
+    def __getattr__(self, method):
+        if method.startswith("_"):
+            raise AttributeError(method)
+
+        async def call(**kwargs):
+            self.calls.append((method, kwargs))
+            if self.latency:
+                await asyncio.sleep(self.latency)
+            self._next_id += 1
+            return SimpleNamespace(message_id=self._next_id)
+
+        return call
+
+
+# ============ SYNTHETIC MESSAGES ============
+class MessageFactory:
+    def __init__(self, seed: int = 1):
+        self.rnd = random.Random(seed)
+        self.msg_id = 1000
+        self.group_id = 5000
+
+    def _text(self, lo=3, hi=40) -> str:
+        r = self.rnd
+        return " ".join(r.choice(WORDS) + r.choice(NOISE) for _ in range(r.randint(lo, hi)))
+
+    def _base(self, **extra) -> dict:
+        self.msg_id += 1
+        d = {
+            "message_id": self.msg_id,
+            "date": int(time.time()),
+            "chat": {"id": bot.SOURCE_CHAT_ID, "type": "channel", "title": "Source"},
+        }
+        d.update(extra)
+        return d
+
+    def _media(self, kind: str) -> dict:
+        uid = f"{kind}{self.msg_id}"
+        if kind == "photo":
+            return {"photo": [
+                {"file_id": f"{uid}s", "file_unique_id": f"{uid}s", "width": 90, "height": 90},
+                {"file_id": uid, "file_unique_id": uid, "width": 1280, "height": 960},
+            ]}
+        return {"video": {"file_id": uid, "file_unique_id": uid, "width": 1280, "height": 720, "duration": 10}}
+
+    def build(self, d: dict) -> Message:
+        return Message.de_json(d, None)
+
+    def text(self) -> Message:
+        return self.build(self._base(text=self._text()))
+
+    def photo(self) -> Message:
+        return self.build(self._base(caption=self._text(1, 25), **self._media("photo")))
+
+    def video(self) -> Message:
+        return self.build(self._base(caption=self._text(1, 25), **self._media("video")))
+
+    def forwarded(self) -> Message:
+        user = {"id": self.rnd.randint(1, 10**9), "is_bot": False, "first_name": "U", "username": "user_x"}
+        d = self._base(text=self._text())
+        # Bot API 7.0: forward_origin (eski forward_from* maydonlari bot.py da o'qilmaydi)
+        d["forward_origin"] = {"type": "user", "date": d["date"], "sender_user": user}
+        return self.build(d)
+
+    def album(self, size: int) -> list:
+        self.group_id += 1
+        msgs = []
+        for i in range(size):
+            d = self._base(media_group_id=str(self.group_id), **self._media(self.rnd.choice(("photo", "video"))))
+            if i == 0:
+                d["caption"] = self._text(1, 25)
+            msgs.append(self.build(d))
+        return msgs
+
+
+# ============ RUNNERS ============
+def _pct(values, p):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p))]
+
+
+async def _one_post(fake, msg):
+    post = bot.post_from_message(msg)
+    thread_id = bot.topic_thread_id(bot.guess_topic_key(post.text))
+    await bot.send_to_group_with_media(fake, bot.DEST_CHAT_ID, thread_id, post)
+
+
+async def _one_album(app, msgs):
+    key = bot.album_key(msgs[0])
+    bot.ALBUMS[key] = {"msgs": [bot.post_from_message(m) for m in msgs]}
+    fut = await bot.flush_album(app, key)
+    if fut is not None:
+        await fut
+
+
+def _jobs(kind: str, factory: MessageFactory, n: int, fake: FakeBot):
+    app = SimpleNamespace(bot=fake)
+    if kind == "route":
+        texts = [factory._text() for _ in range(n)]
+
+        async def route(t):
+            bot.guess_topic_key(t)
+
+        return [(route, t, 1) for t in texts]
+    if kind.startswith("album"):
+        jobs = []
+        for _ in range(n):
+            size = factory.rnd.randint(2, 10)
+            jobs.append((lambda msgs: _one_album(app, msgs), factory.album(size), size))
+        return jobs
+    make = getattr(factory, kind)
+    return [(lambda m: _one_post(fake, m), make(), 1) for _ in range(n)]
+
+
+async def run_scenario(kind: str, n: int, latency: float) -> dict:
+    bot.SENDER = bot.SendScheduler(rate_per_min=0)  # har event loop uchun yangi; rate limit o'lchanmaydi
+    factory = MessageFactory()
+    fake = FakeBot(latency)
+    jobs = _jobs(kind, factory, n, fake)
+    n_msgs = sum(size for _, _, size in jobs)
+
+    # 1) vaqt
+    lat = []
+    t0 = time.perf_counter()
+    for fn, arg, _ in jobs:
+        s = time.perf_counter()
+        await fn(arg)
+        lat.append(time.perf_counter() - s)
+    total = time.perf_counter() - t0
+    calls = len(fake.calls)
+
+    # 2) xotira (alohida o'tish — tracemalloc vaqtni buzmasligi uchun)
+    jobs = _jobs(kind, MessageFactory(), min(n, 300), FakeBot(0))
+    tracemalloc.start()
+    peaks = []
+    for fn, arg, size in jobs:
+        before = tracemalloc.get_traced_memory()[0]
+        tracemalloc.reset_peak()
+        await fn(arg)
+        peaks.append((tracemalloc.get_traced_memory()[1] - before) / size)
+    tracemalloc.stop()
+
+    return {
+        "scenario": kind,
+        "msgs": n_msgs,
+        "msg_per_s": n_msgs / total if total else 0.0,
+        "p50_ms": _pct(lat, 0.50) * 1000,
+        "p99_ms": _pct(lat, 0.99) * 1000,
+        "api_calls": calls,
+        "alloc_kb_msg": (sum(peaks) / len(peaks) / 1024) if peaks else 0.0,
+    }
+
+
+SCENARIOS = ["route", "text", "photo", "video", "forwarded", "album"]
+
+
+def main(argv=None):
+    ap = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    ap.add_argument("-n", type=int, default=2000, help="har ssenariy uchun post (album) soni")
+    ap.add_argument("--latency", type=float, default=0.0, help="soxta Bot API javob kechikishi (s)")
+    ap.add_argument("--only", nargs="*", choices=SCENARIOS, help="faqat shu ssenariylar")
+    args = ap.parse_args(argv)
+
+    # lokal state.json emas — natijalar har doim standart keyword/sozlamalar bilan
+    bot.STATE = dict(bot.DEFAULT_STATE, keywords=bot.copy_keywords(bot.DEFAULT_KEYWORDS))
+
+    rows = [asyncio.run(run_scenario(k, args.n, args.latency)) for k in (args.only or SCENARIOS)]
+    header = f"{'scenario':<10} {'msgs':>7} {'msg/s':>10} {'p50 ms':>8} {'p99 ms':>8} {'calls':>7} {'KB/msg':>8}"
+    print(header)
+    print("-" * len(header))
+    for r in rows:
+        print(
+            f"{r['scenario']:<10} {r['msgs']:>7} {r['msg_per_s']:>10.0f} {r['p50_ms']:>8.3f} "
+            f"{r['p99_ms']:>8.3f} {r['api_calls']:>7} {r['alloc_kb_msg']:>8.2f}"
+        )
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
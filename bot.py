@@ -4,16 +4,32 @@ import json
 import time
 import logging
 import asyncio
-from typing import Dict, List, Optional
+import bisect
+import hashlib
+import sqlite3
+import sys
+import threading
+import contextlib
+import functools
+import itertools
+from collections import OrderedDict, deque
+from typing import Dict, Hashable, List, Optional, Set, Tuple
+
+_BOOT = time.perf_counter()  # startup hisoboti: PTB import'idan boshlab o'lchanadi
 
 from telegram import (
+    Bot,
+    Message,
+    MessageEntity,
     Update,
     InlineKeyboardButton,
     InlineKeyboardMarkup,
+    InputMediaAudio,
+    InputMediaDocument,
     InputMediaPhoto,
     InputMediaVideo,
 )
-from telegram.error import BadRequest
+from telegram.error import BadRequest, NetworkError, RetryAfter
 from telegram.ext import (
     Application,
     CommandHandler,
@@ -28,7 +44,19 @@ BOT_TOKEN = (os.getenv("BOT_TOKEN") or "").strip()
 ADMIN_IDS_RAW = (os.getenv("ADMIN_IDS") or "").strip()
 SOURCE_CHAT_ID = int((os.getenv("SOURCE_CHAT_ID") or "0").strip() or "0")   # channel id (-100...)
 DEST_CHAT_ID = int((os.getenv("DEST_CHAT_ID") or "0").strip() or "0")       # group id (-100...)
+ROUTES_FILE = (os.getenv("ROUTES_FILE") or "").strip()                          # ko'p kanal -> ko'p guruh (ixtiyoriy)
 BOT_USERNAME = (os.getenv("BOT_USERNAME") or "").strip().lstrip("@")        # optional
+BOT_API_BASE_URL = (os.getenv("BOT_API_BASE_URL") or "").strip().rstrip("/")  # lokal/soxta Bot API (loadtest)
+SEND_RATE_PER_MIN = float((os.getenv("SEND_RATE_PER_MIN") or "20").strip() or "20")  # har guruhga (0 = cheklovsiz)
+SEND_BURST = int((os.getenv("SEND_BURST") or "3").strip() or "3")
+METRICS_PORT = int((os.getenv("METRICS_PORT") or "0").strip() or "0")               # 0 = o'chiq
+METRICS_HOST = (os.getenv("METRICS_HOST") or "127.0.0.1").strip()                  # tashqaridan scrape: 0.0.0.0
+TRACE_UPDATES = (os.getenv("TRACE_UPDATES") or "").strip().lower() in ("1", "true", "yes")
+WEBHOOK_URL = (os.getenv("WEBHOOK_URL") or "").strip().rstrip("/")             # bo'lsa webhook, aks holda polling
+WEBHOOK_PATH = (os.getenv("WEBHOOK_PATH") or "telegram").strip().strip("/")
+WEBHOOK_SECRET = (os.getenv("WEBHOOK_SECRET") or "").strip() or None
+PORT = int((os.getenv("PORT") or "8080").strip() or "8080")
+CONCURRENT_UPDATES = int((os.getenv("CONCURRENT_UPDATES") or "64").strip() or "64")
 
 ADMIN_IDS: List[int] = []
 if ADMIN_IDS_RAW:
@@ -41,6 +69,135 @@ if ADMIN_IDS_RAW:
 logging.basicConfig(level=logging.INFO, format="%(asctime)s | %(levelname)s | %(message)s")
 log = logging.getLogger("channel_to_group")
 
+class StartupTimer:
+    """Ishga tushish bosqichlari va birinchi update'gacha bo'lgan vaqt (logga)."""
+
+    def __init__(self, t0: float):
+        self.t0 = t0
+        self.last = t0
+        self.steps: List[tuple] = []
+        self.first_seen = False
+
+    def mark(self, name: str):
+        now = time.perf_counter()
+        self.steps.append((name, now - self.last))
+        self.last = now
+
+    def report(self):
+        steps = " | ".join(f"{name} {sec * 1000:.0f} ms" for name, sec in self.steps)
+        log.info("Startup: %s | jami %.0f ms", steps, (self.last - self.t0) * 1000)
+
+    def first_update(self):
+        if not self.first_seen:
+            self.first_seen = True
+            log.info("Birinchi update: ishga tushgandan %.0f ms keyin", (time.perf_counter() - self.t0) * 1000)
+
+STARTUP = StartupTimer(_BOOT)
+
+# ============ METRICS (Prometheus text format) ============
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+METRICS: list = []
+
+def _labels(names: tuple, values: tuple) -> str:
+    if not names:
+        return ""
+    return "{" + ",".join(f'{n}="{v}"' for n, v in zip(names, values)) + "}"
+
+class Counter:
+    def __init__(self, name: str, help_text: str, labels: tuple = ()):
+        self.name, self.help, self.labels = name, help_text, labels
+        self.values: Dict[tuple, float] = {}
+        METRICS.append(self)
+
+    def inc(self, *label_values, amount: float = 1.0):
+        self.values[label_values] = self.values.get(label_values, 0.0) + amount
+
+    def render(self) -> List[str]:
+        out = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} counter"]
+        for lv, v in sorted(self.values.items()):
+            out.append(f"{self.name}{_labels(self.labels, lv)} {v:g}")
+        return out
+
+class Histogram:
+    def __init__(self, name: str, help_text: str, buckets: tuple = LATENCY_BUCKETS, labels: tuple = ()):
+        self.name, self.help, self.labels, self.buckets = name, help_text, labels, buckets
+        self.series: Dict[tuple, list] = {}  # labels -> [bucket_0..bucket_n, +Inf, sum]
+        METRICS.append(self)
+
+    def observe(self, value: float, *label_values):
+        row = self.series.get(label_values)
+        if row is None:
+            row = self.series[label_values] = [0] * (len(self.buckets) + 1) + [0.0]
+        row[bisect.bisect_left(self.buckets, value)] += 1
+        row[-1] += value
+
+    def render(self) -> List[str]:
+        out = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        for lv, row in sorted(self.series.items()):
+            acc = 0
+            for le, n in zip(self.buckets + ("+Inf",), row):
+                acc += n
+                out.append(f"{self.name}_bucket{_labels(self.labels + ('le',), lv + (le,))} {acc}")
+            out.append(f"{self.name}_sum{_labels(self.labels, lv)} {row[-1]:g}")
+            out.append(f"{self.name}_count{_labels(self.labels, lv)} {acc}")
+        return out
+
+class Gauge:
+    """Qiymat scrape paytida funksiyadan olinadi (navbat uzunligi va h.k.)."""
+
+    def __init__(self, name: str, help_text: str, fn):
+        self.name, self.help, self.fn = name, help_text, fn
+        METRICS.append(self)
+
+    def render(self) -> List[str]:
+        return [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} gauge", f"{self.name} {self.fn():g}"]
+
+def render_metrics() -> str:
+    lines: List[str] = []
+    for m in METRICS:
+        lines.extend(m.render())
+    return "\n".join(lines) + "\n"
+
+async def _metrics_conn(reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+    try:
+        request = await asyncio.wait_for(reader.readline(), 5)
+        while (await asyncio.wait_for(reader.readline(), 5)) not in (b"\r\n", b"\n", b""):
+            pass
+        path = request.split(b" ")[1] if request.count(b" ") >= 2 else b"/"
+        if path.startswith(b"/metrics"):
+            status, body = "200 OK", render_metrics().encode()
+        else:
+            status, body = "404 Not Found", b"not found\n"
+        writer.write(
+            f"HTTP/1.1 {status}\r\nContent-Type: text/plain; version=0.0.4\r\n"
+            f"Content-Length: {len(body)}\r\nConnection: close\r\n\r\n".encode() + body
+        )
+        await writer.drain()
+    except Exception:
+        pass
+    finally:
+        writer.close()
+
+async def start_metrics_server(port: int, host: str = METRICS_HOST):
+    server = await asyncio.start_server(_metrics_conn, host, port)
+    log.info("📈 Metrics: http://%s:%s/metrics", host, port)
+    return server
+
+POSTS_RECEIVED = Counter("posts_received_total", "Source kanaldan kelgan postlar")
+POSTS_ROUTED = Counter("posts_routed_total", "Topic bo'yicha yo'naltirilgan postlar", ("topic",))
+KEYWORD_MATCH_SECONDS = Histogram(
+    "keyword_match_seconds", "classify_topic vaqti",
+    (0.00001, 0.00005, 0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01),
+)
+BOT_API_SECONDS = Histogram("bot_api_call_seconds", "Bot API chaqiruv vaqti", labels=("method",))
+THREAD_FALLBACKS = Counter("thread_fallback_total", "Thread topilmadi: not_found = qayta yuborildi, skipped = eslab qolingan", ("kind",))
+RETRY_AFTER = Counter("retry_after_total", "RetryAfter javoblari")
+RETRY_AFTER_SECONDS = Counter("retry_after_seconds_total", "RetryAfter bo'yicha kutilgan soniyalar")
+SEND_QUEUE_WAIT = Histogram("send_queue_wait_seconds", "Post navbatda kutgan vaqt")
+SEND_JOB_SECONDS = Histogram("send_job_seconds", "Navbatdagi bitta yuborish ishi (retry bilan)")
+ALBUM_SIZE = Histogram("album_size", "Albumdagi elementlar soni", (1, 2, 3, 4, 5, 6, 7, 8, 9, 10, 20))
+ALBUM_ASSEMBLY_SECONDS = Histogram("album_assembly_seconds", "Album yig'ilish vaqti", (0.1, 0.25, 0.5, 0.75, 1.0, 1.5, 2.0, 3.0, 5.0))
+
 # ============ TOPICS (siz bergan kodlar) ============
 TOPICS = {
     "umumiy": 1,
@@ -102,15 +259,35 @@ DEFAULT_KEYWORDS: Dict[str, List[str]] = {
 }
 
 STATE_FILE = "state.json"
+WAL_FILE = (os.getenv("WAL_FILE") or "wal.sqlite3").strip()
 
 DEFAULT_STATE = {
     "mode": "auto",              # auto | manual
     "default_topic": "umumiy",    # fallback
     "keywords": DEFAULT_KEYWORDS,
+    "weights": {},                # {"topic": {"keyword": 2.0}} — default og'irlik 1.0
+    "min_score": 1.0,             # shundan past ball -> ishonch yo'q
+    "low_confidence": "default",  # default | manual (adminlar tanlaydi)
+    "copy_mode": True,            # copy_message(s) | qo'lda qayta yuborish (file_id)
+    "dedup": "skip",              # skip | link | off — takroriy e'lonlar
+    "dedup_window_sec": 43200,    # shu oraliqda (12 soat) takror bo'lsa
     "last_seen_channel_msg_id": 0,
 }
 
 STATE = {}
+STATE_SAVE_DELAY = 1.0  # shu oraliqdagi o'zgarishlar bitta yozuvga jamlanadi
+# version: routing tuzilmalari (classifier) qachon qayta qurilishini bildiradi
+# dirty/written: diskka yozilmagan o'zgarishlar hisobi
+_STATE_META = {"version": 0, "dirty": 0, "written": 0, "task": None}
+# fon (to_thread) va shutdown (flush_state) yozuvlari navbat bilan; eskisi yangisini bosmaydi
+_STATE_WRITE_LOCK = threading.Lock()
+
+def state_version() -> int:
+    return _STATE_META["version"]
+
+def copy_keywords(kw: Dict[str, List[str]]) -> Dict[str, List[str]]:
+    """STATE["keywords"] hech qachon DEFAULT_KEYWORDS (yoki boshqa dict) bilan umumiy bo'lmasin."""
+    return {k: list(v) for k, v in kw.items()}
 
 def load_state():
     global STATE
@@ -118,60 +295,362 @@ def load_state():
         try:
             with open(STATE_FILE, "r", encoding="utf-8") as f:
                 STATE = json.load(f) or {}
-        except Exception:
+        except Exception as e:
+            log.warning("State load failed (%s), defaults ishlatiladi: %s", STATE_FILE, e)
             STATE = {}
     for k, v in DEFAULT_STATE.items():
         if k not in STATE:
             STATE[k] = v
-    if "keywords" not in STATE or not isinstance(STATE["keywords"], dict):
-        STATE["keywords"] = DEFAULT_KEYWORDS
+    if "keywords" not in STATE or not isinstance(STATE["keywords"], dict) or STATE["keywords"] is DEFAULT_KEYWORDS:
+        STATE["keywords"] = copy_keywords(DEFAULT_KEYWORDS)
     if "mode" not in STATE:
         STATE["mode"] = "auto"
     if "default_topic" not in STATE:
         STATE["default_topic"] = "umumiy"
+    _STATE_META["version"] += 1
 
-def save_state():
+def _write_state_file(data: str, dirty: int):
+    """
+    Atomik: vaqtinchalik faylga yozib, rename qilamiz — yarim yozilgan state.json bo'lmaydi.
+    dirty — snapshot olingandagi hisob; diskda undan yangisi bo'lsa yozilmaydi.
+    """
+    with _STATE_WRITE_LOCK:
+        if dirty <= _STATE_META["written"]:
+            return
+        tmp = STATE_FILE + ".tmp"
+        with open(tmp, "w", encoding="utf-8") as f:
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, STATE_FILE)
+        _STATE_META["written"] = dirty
+
+def _write_state_now():
     try:
-        with open(STATE_FILE, "w", encoding="utf-8") as f:
-            json.dump(STATE, f, ensure_ascii=False, indent=2)
+        _write_state_file(json.dumps(STATE, ensure_ascii=False), _STATE_META["dirty"])
     except Exception as e:
         log.warning("State save failed: %s", e)
 
+def flush_state():
+    """Yozilmagan o'zgarishlar bo'lsa hozir (sinxron) yozadi — shutdown uchun."""
+    if _STATE_META["written"] != _STATE_META["dirty"]:
+        _write_state_now()
+
+async def _save_state_later():
+    try:
+        while True:
+            await asyncio.sleep(STATE_SAVE_DELAY)
+            dirty = _STATE_META["dirty"]
+            if _STATE_META["written"] == dirty:
+                return
+            data = json.dumps(STATE, ensure_ascii=False)  # snapshot loop ichida, yozish thread'da
+            try:
+                await asyncio.to_thread(_write_state_file, data, dirty)
+            except Exception as e:
+                log.warning("State save failed: %s", e)
+                return
+    finally:
+        _STATE_META["task"] = None
+
+def save_state(bump_version: bool = True):
+    """
+    STATE o'zgarganini belgilaydi; fayl STATE_SAVE_DELAY dan keyin fonda yoziladi.
+    bump_version=False — routingga ta'sir qilmaydigan o'zgarishlar (masalan last_seen).
+    """
+    if bump_version:
+        _STATE_META["version"] += 1
+    _STATE_META["dirty"] += 1
+    try:
+        loop = asyncio.get_running_loop()
+    except RuntimeError:
+        _write_state_now()
+        return
+    if _STATE_META["task"] is None:
+        _STATE_META["task"] = loop.create_task(_save_state_later())
+
 def is_admin(user_id: int) -> bool:
     return user_id in ADMIN_IDS
 
+# ============ KEYWORD MATCHER (bir marta kompilyatsiya) ============
+# o‘rin / o'rin / oʻrin — hammasi bitta apostrofga keltiriladi
+_APOSTROPHES = str.maketrans({"‘": "'", "’": "'", "ʻ": "'", "ʼ": "'", "`": "'", "´": "'"})
+_WS_RE = re.compile(r"\s+")
+
 def clean_text_for_match(text: str) -> str:
-    text = (text or "").lower()
-    text = re.sub(r"\s+", " ", text)
+    text = (text or "").lower().translate(_APOSTROPHES)
+    text = _WS_RE.sub(" ", text)
     return text
 
-def guess_topic_key(text: str) -> str:
-    t = clean_text_for_match(text)
-    kw = STATE.get("keywords", DEFAULT_KEYWORDS)
-    for topic_key, words in kw.items():
-        for w in sorted(words, key=len, reverse=True):
-            w2 = clean_text_for_match(w)
-            if w2 and w2 in t:
-                return topic_key
-    return STATE.get("default_topic", "umumiy")
+def _trie_pattern(words) -> str:
+    """So'zlardan prefiks-daraxt (trie) regex: ha(?:ram(?:ga)?|...) — minglab so'zda ham tez."""
+    trie: Dict = {}
+    for w in words:
+        node = trie
+        for ch in w:
+            node = node.setdefault(ch, {})
+        node[""] = {}
+
+    def build(node: Dict) -> str:
+        end = "" in node
+        branches = [re.escape(ch) + build(sub) for ch, sub in sorted(node.items()) if ch]
+        if not branches:
+            return ""
+        if len(branches) == 1 and not end:
+            return branches[0]
+        alt = "(?:" + "|".join(branches) + ")"
+        return alt + "?" if end else alt
+
+    return build(trie)
+
+class KeywordClassifier:
+    """
+    Bitta regex bilan postni bir marta o'tib, har topic uchun ball yig'adi.
+    Kalit so'z so'z boshidan mos kelishi kerak ("km" -> "tekmoq" ichida emas),
+    oxiri ochiq — qo'shimchalar bilan ham ishlaydi (makk -> makkaga).
+    """
+
+    def __init__(self, keywords: Dict[str, List[str]], weights: Optional[Dict[str, Dict[str, float]]] = None):
+        self.topics = list(keywords)
+        table: Dict[str, Dict[int, float]] = {}
+        for i, (topic_key, words) in enumerate(keywords.items()):
+            tw = (weights or {}).get(topic_key) or {}
+            for w in words:
+                w2 = clean_text_for_match(w)
+                if not w2:
+                    continue
+                table.setdefault(w2, {})[i] = float(tw.get(w, tw.get(w2, 1.0)))
+        # so'z -> ((topic_index, weight), ...)
+        self.table = {w: tuple(v.items()) for w, v in table.items()}
+        self.rx = re.compile(r"(?<!\w)" + _trie_pattern(self.table)) if self.table else None
+
+    def _best(self, scores: List[float], first_kw: List[Optional[str]]) -> tuple:
+        best_i, best = -1, 0.0
+        for i, sc in enumerate(scores):
+            if sc > best:
+                best_i, best = i, sc
+        if best_i < 0:
+            return None, 0.0, None
+        return self.topics[best_i], best, first_kw[best_i]
+
+    def classify(self, text: str) -> tuple:
+        """(topic_key | None, score, birinchi mos kelgan so'z)"""
+        n = len(self.topics)
+        scores = [0.0] * n
+        first_kw: List[Optional[str]] = [None] * n
+        if self.rx is not None:
+            table = self.table
+            for m in self.rx.finditer(clean_text_for_match(text)):
+                w = m.group()
+                for i, wt in table[w]:
+                    scores[i] += wt
+                    if first_kw[i] is None:
+                        first_kw[i] = w
+        return self._best(scores, first_kw)
+
+    def classify_many(self, texts: List[str]) -> List[tuple]:
+        """Ko'p postni bitta regex o'tishida baholaydi (matnlar '\\n' bilan ulanadi)."""
+        cleaned = [clean_text_for_match(t) for t in texts]
+        n = len(self.topics)
+        scores = [[0.0] * n for _ in cleaned]
+        first_kw = [[None] * n for _ in cleaned]
+        if self.rx is not None and cleaned:
+            # clean_text_for_match "\n" ni bo'sh joyga aylantiradi -> ajratgich matn ichida uchramaydi
+            starts, pos = [], 0
+            for t in cleaned:
+                starts.append(pos)
+                pos += len(t) + 1
+            table = self.table
+            for m in self.rx.finditer("\n".join(cleaned)):
+                j = bisect.bisect_right(starts, m.start()) - 1
+                w = m.group()
+                sc, fk = scores[j], first_kw[j]
+                for i, wt in table[w]:
+                    sc[i] += wt
+                    if fk[i] is None:
+                        fk[i] = w
+        return [self._best(sc, fk) for sc, fk in zip(scores, first_kw)]
+
+# ============ ROUTES (source kanal -> guruh) ============
+class Route:
+    """
+    Bitta source kanal -> bitta guruh: o'z topic xaritasi, (ixtiyoriy) kalit so'zlari va default topici.
+    keywords berilmasa STATE["keywords"] (admin tahrirlaydigan) ishlatiladi.
+    """
+
+    def __init__(self, idx: int, name: str, source: int, dest: int, topics: Dict[str, int],
+                 keywords: Optional[Dict[str, List[str]]] = None, weights: Optional[Dict[str, Dict[str, float]]] = None,
+                 default_topic: Optional[str] = None, labels: Optional[Dict[str, str]] = None):
+        self.idx = idx
+        self.name = name
+        self.source = source
+        self.dest = dest
+        self.topics = topics
+        self.keywords = keywords
+        self.weights = weights
+        self.default_topic = default_topic
+        self.labels = labels or {}
+        self._clf: Optional[KeywordClassifier] = None
+        self._clf_src: tuple = ()
+        self._picker_rows: Optional[tuple] = None
+        self._default_kb: Optional[InlineKeyboardMarkup] = None
+
+    def get_keywords(self) -> Dict[str, List[str]]:
+        return self.keywords if self.keywords is not None else STATE.get("keywords", DEFAULT_KEYWORDS)
+
+    def get_weights(self) -> Optional[Dict[str, Dict[str, float]]]:
+        return self.weights if self.keywords is not None else STATE.get("weights")
+
+    def default(self) -> str:
+        return self.default_topic or STATE.get("default_topic", "umumiy")
+
+    def label(self, topic_key: str) -> str:
+        return self.labels.get(topic_key) or TOPIC_LABELS_UZ.get(topic_key, topic_key)
+
+    def thread_id(self, topic_key: str) -> Optional[int]:
+        tid = self.topics.get(topic_key)
+        return tid if tid is not None else self.topics.get(self.default())
+
+ROUTES: List[Route] = []
+ROUTES_BY_SOURCE: Dict[int, List[Route]] = {}
+
+def load_routes():
+    """
+    ROUTES_FILE (JSON) bo'lsa undan, aks holda SOURCE_CHAT_ID/DEST_CHAT_ID/TOPICS dan.
+    Format: [{"name": "madina", "source": -100.., "dest": -100.., "topics": {"umumiy": 1, ...},
+              "keywords": {...}, "weights": {...}, "default_topic": "umumiy", "labels": {...}}, ...]
+    """
+    routes: List[Route] = []
+    if ROUTES_FILE:
+        with open(ROUTES_FILE, "r", encoding="utf-8") as f:
+            for i, r in enumerate(json.load(f)):
+                routes.append(Route(
+                    i, r.get("name") or f"{r['source']}->{r['dest']}", int(r["source"]), int(r["dest"]),
+                    {k: int(v) for k, v in (r.get("topics") or TOPICS).items()},
+                    r.get("keywords"), r.get("weights"), r.get("default_topic"), r.get("labels"),
+                ))
+    else:
+        routes.append(Route(0, "default", SOURCE_CHAT_ID, DEST_CHAT_ID, TOPICS))
+    by_source: Dict[int, List[Route]] = {}
+    for r in routes:
+        by_source.setdefault(r.source, []).append(r)
+    ROUTES[:] = routes
+    ROUTES_BY_SOURCE.clear()
+    ROUTES_BY_SOURCE.update(by_source)
+
+def routes_for(source_chat_id: int) -> List[Route]:
+    if not ROUTES:
+        load_routes()
+    return ROUTES_BY_SOURCE.get(source_chat_id, [])
+
+def primary_route() -> Route:
+    if not ROUTES:
+        load_routes()
+    return ROUTES[0]
+
+def get_matcher(route: Optional[Route] = None) -> KeywordClassifier:
+    """State versiyasi o'zgarsa (yoki keywords/weights dict almashtirilsa) classifier qayta quriladi."""
+    route = route or primary_route()
+    kw, weights = route.get_keywords(), route.get_weights()
+    src = route._clf_src
+    if route._clf is None or src[0] != state_version() or src[1] is not kw or src[2] is not weights:
+        route._clf = KeywordClassifier(kw, weights)
+        route._clf_src = (state_version(), kw, weights)
+    return route._clf
+
+def _confident(score: float) -> bool:
+    return score > 0 and score >= float(STATE.get("min_score", 1.0))
+
+def classify_topic(text: str, route: Optional[Route] = None) -> tuple:
+    """(topic_key, score, keyword). Ball min_score dan past bo'lsa topic_key = None."""
+    route = route or primary_route()
+    matcher = get_matcher(route)  # qayta qurish (keyword o'zgargach) o'lchovga kirmaydi
+    t0 = time.perf_counter()
+    topic_key, score, keyword = matcher.classify(text)
+    sec = time.perf_counter() - t0
+    KEYWORD_MATCH_SECONDS.observe(sec)
+    confident = _confident(score)
+    DECISIONS.record(route.idx, topic_key if confident else route.default(), not confident, keyword, topic_key, len(text or ""), sec)
+    if not confident:
+        return None, score, keyword
+    return topic_key, score, keyword
+
+def guess_topic_key(text: str, route: Optional[Route] = None) -> str:
+    return classify_topic(text, route)[0] or (route or primary_route()).default()
+
+def classify_many(texts: List[str], route: Optional[Route] = None) -> List[str]:
+    """Backlog uchun: ko'p postni birdaniga topicga ajratadi."""
+    route = route or primary_route()
+    default_topic = route.default()
+    return [
+        topic_key if topic_key and _confident(score) else default_topic
+        for topic_key, score, _ in get_matcher(route).classify_many(texts)
+    ]
 
-def topic_thread_id(topic_key: str) -> int:
-    return TOPICS.get(topic_key, TOPICS["umumiy"])
+def topic_thread_id(topic_key: str, route: Optional[Route] = None) -> Optional[int]:
+    return (route or primary_route()).thread_id(topic_key)
+
+# ============ KEYBOARDS ============
+# Tugmalar route.topics + label'lardan yasaladi: yangi topic qo'shilsa kod o'zgarmaydi.
+# InlineKeyboardMarkup o'zgarmas obyekt — tayyor markup'lar kesh'da qayta ishlatiladi.
+def topic_layout(route: Route, per_row: int = 2) -> tuple:
+    """((label, topic_key), ...) qatorlari; route bo'yicha bir marta hisoblanadi."""
+    if route._picker_rows is None:
+        items = [(route.label(k), k) for k in route.topics]
+        route._picker_rows = tuple(tuple(items[i:i + per_row]) for i in range(0, len(items), per_row))
+    return route._picker_rows
+
+def topic_buttons(route: Route, prefix: str) -> List[List[InlineKeyboardButton]]:
+    return [[InlineKeyboardButton(label, callback_data=prefix + k) for label, k in row] for row in topic_layout(route)]
+
+def topic_picker_kb(route: Route, ch_msg_id: int) -> InlineKeyboardMarkup:
+    # layout keshdan, har postda faqat callback_data dagi post id o'zgaradi
+    return InlineKeyboardMarkup(topic_buttons(route, f"pick:{route.idx}:{ch_msg_id}:"))
+
+def default_topic_kb(route: Route) -> InlineKeyboardMarkup:
+    if route._default_kb is None:
+        route._default_kb = InlineKeyboardMarkup(
+            topic_buttons(route, "def:") + [[InlineKeyboardButton("⬅️ Orqaga", callback_data="adm:back")]]
+        )
+    return route._default_kb
 
 def admin_panel_kb() -> InlineKeyboardMarkup:
-    mode = STATE.get("mode", "auto")
+    return _admin_panel_kb(STATE.get("mode", "auto"), STATE.get("default_topic", "umumiy"), bool(STATE.get("copy_mode", True)))
+
+@functools.lru_cache(maxsize=64)
+def _admin_panel_kb(mode: str, default_key: str, copy_mode: bool) -> InlineKeyboardMarkup:
     mode_label = "✅ AUTO" if mode == "auto" else "🖐 MANUAL"
-    default_key = STATE.get("default_topic", "umumiy")
     default_label = TOPIC_LABELS_UZ.get(default_key, default_key)
+    copy_label = "📋 COPY" if copy_mode else "⬆️ UPLOAD"
     kb = [
         [InlineKeyboardButton(f"Rejim: {mode_label}", callback_data="adm:toggle_mode")],
         [InlineKeyboardButton(f"Default: {default_label}", callback_data="adm:set_default")],
+        [InlineKeyboardButton(f"Yuborish: {copy_label}", callback_data="adm:toggle_copy")],
         [InlineKeyboardButton("🧠 Keywords ko‘rish", callback_data="adm:show_keywords")],
         [InlineKeyboardButton("♻️ Keywords defaultga qaytarish", callback_data="adm:reset_keywords")],
     ]
     return InlineKeyboardMarkup(kb)
 
 # ============ SAFE SENDERS (thread not found -> send WITHOUT thread) ============
+# media turi -> (Bot API metodi, fayl parametri, qo'shimcha kwargs)
+MEDIA_SENDERS = {
+    "photo": ("send_photo", "photo", {}),
+    "video": ("send_video", "video", {"supports_streaming": True}),
+    "animation": ("send_animation", "animation", {}),
+    "document": ("send_document", "document", {}),
+    "voice": ("send_voice", "voice", {}),
+    "audio": ("send_audio", "audio", {}),
+}
+
+# (chat_id, thread_id) -> "thread not found" bo'lgan vaqt; TTL ichida thread'siz yuboramiz
+MISSING_THREADS: Dict[tuple, float] = {}
+MISSING_THREAD_TTL = 600.0
+
+def media_kind(msg) -> Optional[str]:
+    for kind in MEDIA_SENDERS:
+        if getattr(msg, kind, None):
+            return kind
+    return None
+
 def _thread_kwargs(thread_id: Optional[int]) -> dict:
     return {"message_thread_id": thread_id} if thread_id else {}
 
@@ -179,250 +658,1175 @@ def _is_thread_not_found(e: Exception) -> bool:
     s = str(e)
     return "Message thread not found" in s or "message thread not found" in s
 
-async def safe_send_message(bot, chat_id: int, text: str, thread_id: Optional[int] = None, entities=None):
-    try:
-        return await bot.send_message(chat_id=chat_id, text=text, entities=entities, **_thread_kwargs(thread_id))
-    except BadRequest as e:
-        if _is_thread_not_found(e):
-            log.warning("Thread not found (%s). Sending message without thread.", thread_id)
-            return await bot.send_message(chat_id=chat_id, text=text, entities=entities)
-        raise
+def _thread_missing(chat_id: int, thread_id: int) -> bool:
+    ts = MISSING_THREADS.get((chat_id, thread_id))
+    if ts is None:
+        return False
+    if time.monotonic() - ts > MISSING_THREAD_TTL:
+        MISSING_THREADS.pop((chat_id, thread_id), None)
+        return False
+    return True
 
-async def safe_send_photo(bot, chat_id: int, file_id: str, thread_id: Optional[int] = None, caption=None, caption_entities=None):
+async def safe_call(bot, method: str, chat_id: int, thread_id: Optional[int] = None, **kwargs):
+    """
+    Bot API chaqiruvi; thread topilmasa thread'siz qayta yuboradi va buni eslab qoladi.
+    Token bucket va RetryAfter/tarmoq xatolari SENDER.call da — har bitta chaqiruv uchun,
+    shuning uchun ko'p chaqiruvli ishda muvaffaqiyatli bo'lganlari qayta yuborilmaydi.
+    """
+    if thread_id and _thread_missing(chat_id, thread_id):
+        THREAD_FALLBACKS.inc("skipped")
+        thread_id = None
+    fn = getattr(bot, method)
     try:
-        return await bot.send_photo(chat_id=chat_id, photo=file_id, caption=caption, caption_entities=caption_entities, **_thread_kwargs(thread_id))
+        return await SENDER.call(chat_id, method, lambda: fn(chat_id=chat_id, **kwargs, **_thread_kwargs(thread_id)))
     except BadRequest as e:
-        if _is_thread_not_found(e):
-            log.warning("Thread not found (%s). Sending photo without thread.", thread_id)
-            return await bot.send_photo(chat_id=chat_id, photo=file_id, caption=caption, caption_entities=caption_entities)
+        if thread_id and _is_thread_not_found(e):
+            MISSING_THREADS[(chat_id, thread_id)] = time.monotonic()
+            THREAD_FALLBACKS.inc("not_found")
+            log.warning("Thread not found (%s). %s without thread.", thread_id, method)
+            return await SENDER.call(chat_id, method, lambda: fn(chat_id=chat_id, **kwargs))
         raise
 
-async def safe_send_video(bot, chat_id: int, file_id: str, thread_id: Optional[int] = None, caption=None, caption_entities=None):
-    try:
-        return await bot.send_video(chat_id=chat_id, video=file_id, caption=caption, caption_entities=caption_entities, supports_streaming=True, **_thread_kwargs(thread_id))
-    except BadRequest as e:
-        if _is_thread_not_found(e):
-            log.warning("Thread not found (%s). Sending video without thread.", thread_id)
-            return await bot.send_video(chat_id=chat_id, video=file_id, caption=caption, caption_entities=caption_entities, supports_streaming=True)
-        raise
+async def safe_send_media(bot, chat_id: int, kind: str, file_id: str, thread_id: Optional[int] = None, caption=None, caption_entities=None):
+    method, param, extra = MEDIA_SENDERS[kind]
+    return await safe_call(bot, method, chat_id, thread_id, **{param: file_id}, caption=caption, caption_entities=caption_entities, **extra)
+
+# ============ SEND QUEUE (har guruhga token bucket + RetryAfter) ============
+SEND_MAX_ATTEMPTS = 5
+
+def _retry_after_seconds(e: RetryAfter) -> float:
+    ra = e.retry_after
+    return ra.total_seconds() if hasattr(ra, "total_seconds") else float(ra)
+
+class TokenBucket:
+    def __init__(self, rate_per_min: float, burst: int):
+        self.rate = rate_per_min / 60.0
+        self.burst = max(1, burst)
+        self.tokens = float(self.burst)
+        self.updated = time.monotonic()
+        self.paused_until = 0.0
+
+    def pause(self, seconds: float):
+        """RetryAfter: butun chat uchun shuncha kutamiz."""
+        self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+        self.tokens = 0.0
+        self.updated = self.paused_until
+
+    async def acquire(self):
+        while True:
+            now = time.monotonic()
+            if now < self.paused_until:
+                await asyncio.sleep(self.paused_until - now)
+                continue
+            if self.rate <= 0:
+                return
+            self.tokens = min(self.burst, self.tokens + max(0.0, now - self.updated) * self.rate)
+            self.updated = now
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return
+            await asyncio.sleep((1 - self.tokens) / self.rate)
+
+class SendScheduler:
+    """
+    Har destination chat uchun bitta FIFO navbat va bitta worker:
+    postlar tartibi (topic ichida ham) saqlanadi, burst silliqlanadi.
+    job — argumentsiz async funksiya, bir marta chaqiriladi. Uning ichidagi har bir
+    Bot API chaqiruvi (safe_call -> call) token oladi va RetryAfter'da o'zi qayta urinadi.
+    """
 
-async def safe_send_animation(bot, chat_id: int, file_id: str, thread_id: Optional[int] = None, caption=None, caption_entities=None):
-    try:
-        return await bot.send_animation(chat_id=chat_id, animation=file_id, caption=caption, caption_entities=caption_entities, **_thread_kwargs(thread_id))
-    except BadRequest as e:
-        if _is_thread_not_found(e):
-            log.warning("Thread not found (%s). Sending animation without thread.", thread_id)
-            return await bot.send_animation(chat_id=chat_id, animation=file_id, caption=caption, caption_entities=caption_entities)
-        raise
+    def __init__(self, rate_per_min: float = SEND_RATE_PER_MIN, burst: int = SEND_BURST):
+        self.rate_per_min = rate_per_min
+        self.burst = burst
+        self.queues: Dict[int, asyncio.Queue] = {}
+        self.buckets: Dict[int, TokenBucket] = {}
+        self.workers: Dict[int, asyncio.Task] = {}
+
+    def _bucket(self, chat_id: int) -> TokenBucket:
+        bucket = self.buckets.get(chat_id)
+        if bucket is None:
+            bucket = self.buckets[chat_id] = TokenBucket(self.rate_per_min, self.burst)
+        return bucket
+
+    def submit(self, chat_id: int, job, label: str = "") -> asyncio.Future:
+        q = self.queues.get(chat_id)
+        if q is None:
+            q = self.queues[chat_id] = asyncio.Queue()
+            self.workers[chat_id] = asyncio.create_task(self._worker(chat_id))
+        fut = asyncio.get_running_loop().create_future()
+        # natija kutilmasa ham "exception was never retrieved" chiqmasin
+        fut.add_done_callback(lambda f: f.cancelled() or f.exception())
+        q.put_nowait((job, label, fut, time.monotonic()))
+        return fut
+
+    async def _worker(self, chat_id: int):
+        q = self.queues[chat_id]
+        while True:
+            job, label, fut, enqueued = await q.get()
+            started = time.monotonic()
+            SEND_QUEUE_WAIT.observe(started - enqueued)
+            try:
+                res = await job()
+                if not fut.done():
+                    fut.set_result(res)
+            except Exception as e:
+                log.warning("Send failed (chat %s, %s): %s", chat_id, label, e)
+                if not fut.done():
+                    fut.set_exception(e)
+            finally:
+                done = time.monotonic()
+                SEND_JOB_SECONDS.observe(done - started)
+                if TRACE_UPDATES:
+                    log.info("trace %s: navbat %.0f ms, yuborish %.0f ms", label, (started - enqueued) * 1000, (done - started) * 1000)
+                q.task_done()
+
+    async def call(self, chat_id: int, method: str, fn):
+        """Bitta Bot API chaqiruvi: token oladi; RetryAfter/tarmoq xatosida faqat shu chaqiruv qayta."""
+        bucket = self._bucket(chat_id)
+        backoff = 1.0
+        for attempt in range(1, SEND_MAX_ATTEMPTS + 1):
+            await bucket.acquire()
+            t0 = time.perf_counter()
+            try:
+                return await fn()
+            except RetryAfter as e:
+                wait = _retry_after_seconds(e)
+                log.warning("RetryAfter %.1fs (chat %s, %s)", wait, chat_id, method)
+                RETRY_AFTER.inc()
+                RETRY_AFTER_SECONDS.inc(amount=wait)
+                bucket.pause(wait)
+                if attempt == SEND_MAX_ATTEMPTS:
+                    raise
+            except BadRequest:
+                raise
+            except NetworkError as e:  # TimedOut ham shu yerda
+                if attempt == SEND_MAX_ATTEMPTS:
+                    raise
+                log.warning("Network error (chat %s, %s): %s. %.0fs dan keyin qayta.", chat_id, method, e, backoff)
+                await asyncio.sleep(backoff)
+                backoff = min(backoff * 2, 30.0)
+            finally:
+                BOT_API_SECONDS.observe(time.perf_counter() - t0, method)
+
+    def pending(self) -> int:
+        return sum(q.qsize() for q in self.queues.values())
+
+    async def drain(self, timeout: float = 10.0):
+        """To'xtashdan oldin navbatdagi postlarni yuborib bo'lishga harakat qiladi."""
+        if not self.queues:
+            return
+        try:
+            await asyncio.wait_for(asyncio.gather(*(q.join() for q in self.queues.values())), timeout)
+        except asyncio.TimeoutError:
+            log.warning("Send queue drain timeout: %s ta post qoldi.", self.pending())
 
-async def safe_send_document(bot, chat_id: int, file_id: str, thread_id: Optional[int] = None, caption=None, caption_entities=None):
-    try:
-        return await bot.send_document(chat_id=chat_id, document=file_id, caption=caption, caption_entities=caption_entities, **_thread_kwargs(thread_id))
-    except BadRequest as e:
-        if _is_thread_not_found(e):
-            log.warning("Thread not found (%s). Sending document without thread.", thread_id)
-            return await bot.send_document(chat_id=chat_id, document=file_id, caption=caption, caption_entities=caption_entities)
-        raise
+SENDER = SendScheduler()
 
-async def safe_send_voice(bot, chat_id: int, file_id: str, thread_id: Optional[int] = None, caption=None, caption_entities=None):
-    try:
-        return await bot.send_voice(chat_id=chat_id, voice=file_id, caption=caption, caption_entities=caption_entities, **_thread_kwargs(thread_id))
-    except BadRequest as e:
-        if _is_thread_not_found(e):
-            log.warning("Thread not found (%s). Sending voice without thread.", thread_id)
-            return await bot.send_voice(chat_id=chat_id, voice=file_id, caption=caption, caption_entities=caption_entities)
-        raise
+# ============ WRITE-AHEAD LOG (restart/crash'da post yo'qolmasin) ============
+WAL_KEEP_DAYS = 3
 
-async def safe_send_audio(bot, chat_id: int, file_id: str, thread_id: Optional[int] = None, caption=None, caption_entities=None):
-    try:
-        return await bot.send_audio(chat_id=chat_id, audio=file_id, caption=caption, caption_entities=caption_entities, **_thread_kwargs(thread_id))
-    except BadRequest as e:
-        if _is_thread_not_found(e):
-            log.warning("Thread not found (%s). Sending audio without thread.", thread_id)
-            return await bot.send_audio(chat_id=chat_id, audio=file_id, caption=caption, caption_entities=caption_entities)
-        raise
+class PostLog:
+    """
+    Har bir kanal posti routingdan OLDIN SQLite'ga yoziladi, yetkazilgach ack qilinadi.
+    Ishga tushganda ack qilinmaganlar qayta yuboriladi (at-least-once + dedup).
+    WAL + synchronous=NORMAL: commit'lar fsync qilmaydi, fsync checkpoint'da — batching.
+    """
 
-async def safe_send_media_group(bot, chat_id: int, media: list, thread_id: Optional[int] = None):
-    try:
-        return await bot.send_media_group(chat_id=chat_id, media=media, **_thread_kwargs(thread_id))
-    except BadRequest as e:
-        if _is_thread_not_found(e):
-            log.warning("Thread not found (%s). Sending media_group without thread.", thread_id)
-            return await bot.send_media_group(chat_id=chat_id, media=media)
-        raise
+    def __init__(self, path: str):
+        self.path = path
+        self.db: Optional[sqlite3.Connection] = None
+
+    def open(self):
+        self.db = sqlite3.connect(self.path, isolation_level=None, check_same_thread=False)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        self.db.execute(
+            "CREATE TABLE IF NOT EXISTS posts ("
+            " chat_id INTEGER NOT NULL, message_id INTEGER NOT NULL, payload TEXT NOT NULL,"
+            " status INTEGER NOT NULL DEFAULT 0, ts REAL NOT NULL,"  # 0 pending | 1 yuborildi | 2 xato
+            " PRIMARY KEY (chat_id, message_id))"
+        )
+        # manual rejim navbati (PendingStore spill)
+        self.db.execute("CREATE TABLE IF NOT EXISTS pending (key TEXT PRIMARY KEY, route INTEGER, ts REAL, record TEXT, previews TEXT)")
+        if "previews" not in {row[1] for row in self.db.execute("PRAGMA table_info(pending)")}:
+            self.db.execute("ALTER TABLE pending ADD COLUMN previews TEXT")
+        # backfill (eksport arxivi) qayerga yetgani: key -> oxirgi yuborilgan message_id
+        self.db.execute("CREATE TABLE IF NOT EXISTS backfill (key TEXT PRIMARY KEY, last_id INTEGER NOT NULL, ts REAL)")
+        # checkpoint'dan oldin qolgan, yuborilmagan postlar (route bo'yicha) — keyingi ishga tushishda qayta
+        self.db.execute(
+            "CREATE TABLE IF NOT EXISTS backfill_failed (key TEXT, message_id INTEGER, route INTEGER,"
+            " PRIMARY KEY (key, message_id, route))"
+        )
+        # jonli bot har source kanaldan olgan birinchi post: backfill faqat undan oldingilarni yuboradi.
+        # message_id kanal ichida noyob — pozitsiya kanal bo'yicha; posts kabi tozalanmaydi
+        self.db.execute("CREATE TABLE IF NOT EXISTS live_start (chat_id INTEGER PRIMARY KEY, first_id INTEGER NOT NULL, ts REAL)")
+        # bu jadvaldan oldingi bazalar: hali o'chirilmagan eng eski posts qatoridan
+        self.db.execute(
+            "INSERT OR IGNORE INTO live_start (chat_id, first_id, ts)"
+            " SELECT chat_id, MIN(message_id), MIN(ts) FROM posts GROUP BY chat_id"
+        )
+        # routing statistikasi: soatlik rollup'lar (DecisionLog)
+        self.db.execute(
+            "CREATE TABLE IF NOT EXISTS stats_topic (hour INTEGER, route INTEGER, topic TEXT, fallback INTEGER,"
+            " n INTEGER, chars INTEGER, latency_us INTEGER, PRIMARY KEY (hour, route, topic, fallback))"
+        )
+        self.db.execute(
+            "CREATE TABLE IF NOT EXISTS stats_keyword (hour INTEGER, keyword TEXT, topic TEXT, n INTEGER,"
+            " PRIMARY KEY (hour, keyword, topic))"
+        )
+        # xuddi shular 5 daqiqalik bo'laklarda — "1 soat" oynasi uchun, STATS_RECENT_HOURS saqlanadi
+        self.db.execute(
+            "CREATE TABLE IF NOT EXISTS stats_topic_5m (slot INTEGER, route INTEGER, topic TEXT, fallback INTEGER,"
+            " n INTEGER, chars INTEGER, latency_us INTEGER, PRIMARY KEY (slot, route, topic, fallback))"
+        )
+        self.db.execute(
+            "CREATE TABLE IF NOT EXISTS stats_keyword_5m (slot INTEGER, keyword TEXT, topic TEXT, n INTEGER,"
+            " PRIMARY KEY (slot, keyword, topic))"
+        )
+        self.prune_stats()
+        self.prune_posts()
+
+    def prune_posts(self):
+        """WAL_KEEP_DAYS dan eski, ack qilingan postlar o'chiriladi (ochilganda va soatiga bir marta)."""
+        if self.db is None:
+            return
+        self.db.execute("DELETE FROM posts WHERE status != 0 AND ts < ?", (time.time() - WAL_KEEP_DAYS * 86400,))
 
-async def safe_forward_message(bot, chat_id: int, from_chat_id: int, message_id: int, thread_id: Optional[int] = None):
-    try:
-        return await bot.forward_message(chat_id=chat_id, from_chat_id=from_chat_id, message_id=message_id, **_thread_kwargs(thread_id))
-    except BadRequest as e:
-        if _is_thread_not_found(e):
-            log.warning("Thread not found (%s). Forwarding without thread.", thread_id)
-            return await bot.forward_message(chat_id=chat_id, from_chat_id=from_chat_id, message_id=message_id)
-        raise
+    def prune_stats(self):
+        """ANALYTICS_KEEP_DAYS dan eski soatlik va STATS_RECENT_HOURS dan eski 5 daqiqalik rollup'lar o'chiriladi."""
+        if self.db is None:
+            return
+        now = time.time()
+        for topic_table, kw_table, col, span, keep in (STATS_HOURLY, STATS_5MIN):
+            oldest = int(now // span) - keep // span
+            self.db.execute(f"DELETE FROM {topic_table} WHERE {col} < ?", (oldest,))
+            self.db.execute(f"DELETE FROM {kw_table} WHERE {col} < ?", (oldest,))
+
+    def record(self, post: "PostRecord") -> bool:
+        """False — bu post avval ko'rilgan (dublikat). To'liq Message emas, ixcham PostRecord yoziladi."""
+        if self.db is None:
+            return True
+        cur = self.db.execute(
+            "INSERT OR IGNORE INTO posts (chat_id, message_id, payload, ts) VALUES (?, ?, ?, ?)",
+            (post.chat_id, post.message_id, json.dumps(post.to_dict(), ensure_ascii=False), time.time()),
+        )
+        if cur.rowcount != 1:
+            return False
+        self.db.execute(
+            "INSERT OR IGNORE INTO live_start (chat_id, first_id, ts) VALUES (?, ?, ?)", (post.chat_id, post.message_id, time.time())
+        )
+        if post.message_id > int(STATE.get("last_seen_channel_msg_id") or 0):
+            STATE["last_seen_channel_msg_id"] = post.message_id
+            save_state(bump_version=False)
+        return True
+
+    def ack(self, keys: List[tuple], ok: bool = True):
+        if self.db is None or not keys:
+            return
+        self.db.executemany(
+            "UPDATE posts SET status = ?, ts = ? WHERE chat_id = ? AND message_id = ?",
+            [(1 if ok else 2, time.time(), chat_id, message_id) for chat_id, message_id in keys],
+        )
+
+    def live_start(self, chat_id: int) -> int:
+        """Jonli bot shu kanaldan olgan birinchi message_id (0 — hali hech narsa kelmagan)."""
+        row = self.db.execute("SELECT first_id FROM live_start WHERE chat_id = ?", (chat_id,)).fetchone()
+        return row[0] if row else 0
+
+    def checkpoint(self, key: str) -> int:
+        row = self.db.execute("SELECT last_id FROM backfill WHERE key = ?", (key,)).fetchone()
+        return row[0] if row else 0
+
+    def set_checkpoint(self, key: str, last_id: int):
+        self.db.execute("INSERT OR REPLACE INTO backfill (key, last_id, ts) VALUES (?, ?, ?)", (key, last_id, time.time()))
+
+    def backfill_failed(self, key: str) -> Dict[int, Set[int]]:
+        """message_id -> yuborilmagan route idx'lari."""
+        out: Dict[int, Set[int]] = {}
+        for message_id, route in self.db.execute("SELECT message_id, route FROM backfill_failed WHERE key = ?", (key,)):
+            out.setdefault(message_id, set()).add(route)
+        return out
+
+    def set_backfill_failed(self, key: str, failed: List[tuple], done: List[tuple]):
+        """failed/done — [(message_id, route_idx), ...]."""
+        self.db.executemany("INSERT OR IGNORE INTO backfill_failed (key, message_id, route) VALUES (?, ?, ?)", [(key,) + f for f in failed])
+        self.db.executemany("DELETE FROM backfill_failed WHERE key = ? AND message_id = ? AND route = ?", [(key,) + d for d in done])
+
+    def pending(self, bot=None) -> List["PostRecord"]:
+        if self.db is None:
+            return []
+        rows = self.db.execute("SELECT payload FROM posts WHERE status = 0 ORDER BY chat_id, message_id")
+        out = []
+        for (payload,) in rows:
+            d = json.loads(payload)
+            # eski bazalarda to'liq Message JSON'i yozilgan
+            out.append(post_from_message(Message.de_json(d, bot)) if "chat" in d else PostRecord.from_dict(d, bot))
+        return out
+
+    def close(self):
+        if self.db is not None:
+            self.db.close()
+            self.db = None
+
+POSTLOG = PostLog(WAL_FILE)
+
+# ============ ANALYTICS (routing qarorlari -> soatlik rollup) ============
+ANALYTICS_BUFFER = 4096
+ANALYTICS_FLUSH_SEC = 60.0
+ANALYTICS_KEEP_DAYS = 30
+STATS_WINDOWS = (("1 soat", 1), ("24 soat", 24), ("7 kun", 24 * 7))
+STATS_RECENT_HOURS = 2  # 5 daqiqalik rollup'lar shuncha saqlanadi (1 soatlik oyna uchun)
+# (topic jadvali, keyword jadvali, bo'lak ustuni, bo'lak uzunligi s, saqlash muddati s)
+STATS_HOURLY = ("stats_topic", "stats_keyword", "hour", 3600, ANALYTICS_KEEP_DAYS * 86400)
+STATS_5MIN = ("stats_topic_5m", "stats_keyword_5m", "slot", 300, STATS_RECENT_HOURS * 3600)
+
+class DecisionLog:
+    """
+    classify_topic qarorlari xotiradagi halqa buferga (deque) yoziladi va har
+    ANALYTICS_FLUSH_SEC da rollup'larga qo'shiladi: stats_topic (topic, default'ga
+    tushganmi, soni, matn uzunligi, kechikish) va stats_keyword — soatlik, hamda
+    STATS_RECENT_HOURS muddatga 5 daqiqalik (_5m) nusxasi. Xom qatorlar saqlanmaydi —
+    /stats faqat rollup'larni o'qiydi. Bufer to'lsa eng eskisi tushib qoladi (dropped).
+    """
+
+    def __init__(self, maxlen: int = ANALYTICS_BUFFER):
+        self.buf: deque = deque(maxlen=maxlen)
+        self.dropped = 0
+
+    def record(self, route_idx: int, topic: str, fallback: bool, keyword: Optional[str], kw_topic: Optional[str], chars: int, seconds: float):
+        if len(self.buf) == self.buf.maxlen:
+            self.dropped += 1
+        self.buf.append((time.time(), route_idx, topic, fallback, keyword, kw_topic, chars, seconds))
+
+    def flush(self, db: Optional[sqlite3.Connection]) -> int:
+        if db is None or not self.buf:
+            return 0
+        items = list(self.buf)
+        self.buf.clear()
+        db.execute("BEGIN")
+        try:
+            for rollup in (STATS_HOURLY, STATS_5MIN):
+                self._write_rollup(db, rollup, items)
+            db.execute("COMMIT")
+        except Exception:
+            db.execute("ROLLBACK")
+            raise
+        return len(items)
+
+    @staticmethod
+    def _write_rollup(db: sqlite3.Connection, rollup: tuple, items: list):
+        topic_table, kw_table, col, span, _ = rollup
+        topics: Dict[tuple, list] = {}
+        keywords: Dict[tuple, int] = {}
+        for ts, route_idx, topic, fallback, keyword, kw_topic, chars, seconds in items:
+            bucket = int(ts // span)
+            agg = topics.setdefault((bucket, route_idx, topic, int(fallback)), [0, 0, 0])
+            agg[0] += 1
+            agg[1] += chars
+            agg[2] += int(seconds * 1e6)
+            if keyword:
+                k = (bucket, keyword, kw_topic)
+                keywords[k] = keywords.get(k, 0) + 1
+        db.executemany(
+            f"INSERT INTO {topic_table} ({col}, route, topic, fallback, n, chars, latency_us) VALUES (?, ?, ?, ?, ?, ?, ?)"
+            f" ON CONFLICT ({col}, route, topic, fallback) DO UPDATE SET"
+            " n = n + excluded.n, chars = chars + excluded.chars, latency_us = latency_us + excluded.latency_us",
+            [k + tuple(v) for k, v in topics.items()],
+        )
+        db.executemany(
+            f"INSERT INTO {kw_table} ({col}, keyword, topic, n) VALUES (?, ?, ?, ?)"
+            f" ON CONFLICT ({col}, keyword, topic) DO UPDATE SET n = n + excluded.n",
+            [k + (n,) for k, n in keywords.items()],
+        )
+
+    def summary(self, db: sqlite3.Connection, hours: int) -> dict:
+        """
+        So'nggi `hours` soat: joriy (qisman) bo'lak + undan oldingi to'liq bo'laklar, ya'ni oyna
+        bir bo'lakdan qisqa bo'lishi mumkin. STATS_RECENT_HOURS gacha 5 daqiqalik rollup'dan
+        (1 soat = 55–60 daqiqa), undan uzunlari soatlik rollup'dan.
+        """
+        topic_table, kw_table, col, span, _ = STATS_5MIN if hours <= STATS_RECENT_HOURS else STATS_HOURLY
+        since = int(time.time() // span) - hours * 3600 // span + 1
+        topics: Dict[str, int] = {}
+        total = fallback = chars = latency_us = 0
+        for topic, fb, n, ch, lat in db.execute(
+            f"SELECT topic, fallback, SUM(n), SUM(chars), SUM(latency_us) FROM {topic_table} WHERE {col} >= ? GROUP BY topic, fallback",
+            (since,),
+        ):
+            topics[topic] = topics.get(topic, 0) + n
+            total += n
+            fallback += n if fb else 0
+            chars += ch
+            latency_us += lat
+        keywords = db.execute(
+            f"SELECT keyword, SUM(n) AS c FROM {kw_table} WHERE {col} >= ? GROUP BY keyword ORDER BY c DESC LIMIT 8",
+            (since,),
+        ).fetchall()
+        return {
+            "total": total,
+            "fallback": fallback,
+            "topics": sorted(topics.items(), key=lambda kv: -kv[1]),
+            "keywords": keywords,
+            "avg_chars": chars / total if total else 0.0,
+            "avg_ms": latency_us / total / 1000 if total else 0.0,
+        }
+
+DECISIONS = DecisionLog()
+
+async def analytics_flusher():
+    hour = None
+    while True:
+        await asyncio.sleep(ANALYTICS_FLUSH_SEC)
+        try:
+            DECISIONS.flush(POSTLOG.db)
+            # uzoq ishlaydigan jarayonda ham eski rollup'lar va WAL qatorlari to'planmasin (soatiga bir marta)
+            if hour != int(time.time() // 3600):
+                hour = int(time.time() // 3600)
+                POSTLOG.prune_stats()
+                POSTLOG.prune_posts()
+        except Exception as e:
+            log.warning("Analytics flush failed: %s", e)
+
+def ack_when_done(fut: asyncio.Future, msgs: list) -> asyncio.Future:
+    """Yuborish tugagach WAL'da ack; bekor qilinsa (shutdown) pending qoladi -> replay."""
+    keys = [(m.chat_id, m.message_id) for m in msgs]
+
+    def done(f: asyncio.Future):
+        if not f.cancelled():
+            POSTLOG.ack(keys, ok=f.exception() is None)
+
+    fut.add_done_callback(done)
+    return fut
+
+# ============ DEDUP (takroriy e'lonlar) ============
+DEDUP_MAX_ENTRIES = int((os.getenv("DEDUP_MAX_ENTRIES") or "5000").strip() or "5000")  # xotira chegarasi
+DEDUP_MIN_WORDS = 5           # bundan qisqa matnlar taqqoslanmaydi ("Salom" dublikat emas)
+SIMHASH_MAX_DISTANCE = 8      # 64 bitdan shuncha farq — "deyarli bir xil"
+SIMHASH_BANDS = 9             # 9 x 7 bit: masofa <= 8 bo'lsa kamida bitta bo'lak to'liq mos keladi
+_WORD_RE = re.compile(r"\w+")
+DUPLICATES = Counter("duplicates_total", "Takroriy deb topilgan postlar", ("action",))
+
+def simhash(text: str) -> Optional[int]:
+    """So'zlar va 2 so'zli shingle'lardan 64-bit SimHash; matn juda qisqa bo'lsa None."""
+    words = _WORD_RE.findall(clean_text_for_match(text))
+    if len(words) < DEDUP_MIN_WORDS:
+        return None
+    features = words + [words[i] + " " + words[i + 1] for i in range(len(words) - 1)]
+    hashes = [
+        format(int.from_bytes(hashlib.blake2b(f.encode(), digest_size=8).digest(), "big"), "064b")
+        for f in features
+    ]
+    # har bit ustuni bo'yicha ko'pchilik ovozi (zip transpozitsiyasi C'da)
+    half = len(hashes) / 2
+    out = 0
+    for col in zip(*hashes):
+        out = (out << 1) | (col.count("1") > half)
+    return out
+
+def media_fingerprint(posts: list) -> frozenset:
+    return frozenset(p.file_unique_id for p in posts if p.file_unique_id)
+
+class DedupCache:
+    """
+    TTL + LRU; SimHash SIMHASH_BANDS bo'lakka indekslanadi (LSH), media esa
+    file_unique_id bo'yicha. Hammasi source ichida.
+    """
+
+    def __init__(self, max_entries: int = DEDUP_MAX_ENTRIES):
+        self.max_entries = max_entries
+        self.entries: "OrderedDict[int, dict]" = OrderedDict()
+        self.index: Dict[tuple, set] = {}
+        self._next = 0
+
+    def _keys(self, entry: dict) -> List[tuple]:
+        src = entry["source"]
+        keys = [(src, "f", uid) for uid in entry["files"]]
+        if entry["sh"] is not None:
+            keys += [(src, "b", i, entry["sh"] >> (7 * i) & 0x7F) for i in range(SIMHASH_BANDS)]
+        return keys
+
+    def _drop(self, entry_id: int):
+        entry = self.entries.pop(entry_id)
+        for k in self._keys(entry):
+            ids = self.index.get(k)
+            if ids:
+                ids.discard(entry_id)
+                if not ids:
+                    del self.index[k]
+
+    def _evict(self, window: float):
+        now = time.monotonic()
+        while self.entries:
+            entry_id, entry = next(iter(self.entries.items()))
+            if len(self.entries) > self.max_entries or now - entry["ts"] > window:
+                self._drop(entry_id)
+            else:
+                break
+
+    @staticmethod
+    def _same(entry: dict, sh: Optional[int], files: frozenset) -> bool:
+        if files or entry["files"]:
+            if entry["files"] != files:
+                return False
+            return sh is None or entry["sh"] is None or bin(sh ^ entry["sh"]).count("1") <= SIMHASH_MAX_DISTANCE
+        return sh is not None and entry["sh"] is not None and bin(sh ^ entry["sh"]).count("1") <= SIMHASH_MAX_DISTANCE
+
+    def check(self, source: int, text: str, files: frozenset, window: float) -> tuple:
+        """(is_duplicate, entry). Dublikat bo'lsa entry — avvalgi post yozuvi."""
+        self._evict(window)
+        now = time.monotonic()
+        sh = simhash(text)
+        probe = {"source": source, "sh": sh, "files": files}
+        candidates = set()
+        for k in self._keys(probe):
+            candidates |= self.index.get(k, set())
+        for entry_id in sorted(candidates):
+            entry = self.entries[entry_id]
+            # move_to_end ts tartibini buzadi: _evict boshidagi muddati o'tmaganda to'xtaydi,
+            # ortidagi eskirganlar LRU bo'yicha chiqguncha qoladi — ular dublikat hisoblanmaydi
+            if now - entry["ts"] > window:
+                continue
+            if self._same(entry, sh, files):
+                self.entries.move_to_end(entry_id)
+                return True, entry
+        if sh is None and not files:
+            return False, None  # taqqoslab bo'lmaydi — saqlamaymiz
+        self._next += 1
+        entry = dict(probe, ts=now, sent={})
+        self.entries[self._next] = entry
+        for k in self._keys(entry):
+            self.index.setdefault(k, set()).add(self._next)
+        self._evict(window)
+        return False, entry
+
+DEDUP = DedupCache()
+
+def dedup_check(msgs: list) -> tuple:
+    """(is_duplicate, entry) — STATE["dedup"] = off bo'lsa doim (False, None)."""
+    if STATE.get("dedup", "skip") == "off":
+        return False, None
+    first = msgs[0]
+    text = " ".join(m.text for m in msgs)
+    return DEDUP.check(first.chat_id, text, media_fingerprint(msgs), float(STATE.get("dedup_window_sec", 43200)))
+
+def _first_message_id(res) -> Optional[int]:
+    if isinstance(res, (list, tuple)):
+        res = next((r for r in res if r is not None), None)
+        return _first_message_id(res) if isinstance(res, (list, tuple)) else getattr(res, "message_id", None)
+    return getattr(res, "message_id", None)
+
+def remember_sent(entry: Optional[dict], route_idx: int, thread_id: Optional[int], fut: asyncio.Future):
+    """Yetkazilgan xabar id'sini dedup yozuviga qo'shadi ("link" rejimi uchun)."""
+    if entry is None:
+        return
+
+    def done(f: asyncio.Future):
+        if not f.cancelled() and f.exception() is None:
+            mid = _first_message_id(f.result())
+            if mid:
+                entry["sent"][route_idx] = (thread_id, mid)
+
+    fut.add_done_callback(done)
+
+async def handle_duplicate(app: Application, entry: dict, msgs: list):
+    """skip: hech narsa qilmaymiz; link: avvalgi postga reply bilan qisqa eslatma."""
+    action = STATE.get("dedup", "skip")
+    DUPLICATES.inc(action)
+    log.info("Takroriy post %s (%s).", msgs[0].message_id, action)
+    POSTLOG.ack([(m.chat_id, m.message_id) for m in msgs])
+    if action != "link":
+        return
+    for route in routes_for(msgs[0].chat_id):
+        ref = entry["sent"].get(route.idx)
+        if not ref:
+            continue
+        thread_id, mid = ref
+        SENDER.submit(
+            route.dest,
+            lambda route=route, thread_id=thread_id, mid=mid: safe_call(
+                app.bot, "send_message", route.dest, thread_id,
+                text="🔁 Bu e’lon yana joylandi (yuqoridagi postga qarang).",
+                reply_to_message_id=mid, allow_sending_without_reply=True,
+            ),
+            f"dup-link {msgs[0].message_id} -> {route.name}",
+        )
 
 # ============ FORWARD CREDIT (nickname / id) ============
+# sender (user/chat) id -> kredit matni; bir xil manbadan ko'p forward bo'lganda qayta hisoblanmaydi
+CREDIT_CACHE_MAX = 1024
+_CREDIT_CACHE: "OrderedDict[int, str]" = OrderedDict()
+
+def _sender_credit(sender) -> str:
+    """User yoki Chat: @username, bo'lmasa kanal/guruh nomi, bo'lmasa id:12345."""
+    credit = _CREDIT_CACHE.get(sender.id)
+    if credit is not None:
+        _CREDIT_CACHE.move_to_end(sender.id)
+        return credit
+    if sender.username:
+        credit = f"@{sender.username}"
+    else:
+        credit = getattr(sender, "title", None) or f"id:{sender.id}"
+    _CREDIT_CACHE[sender.id] = credit
+    if len(_CREDIT_CACHE) > CREDIT_CACHE_MAX:
+        _CREDIT_CACHE.popitem(last=False)
+    return credit
+
 def get_forward_credit(msg) -> Optional[str]:
     """
-    Agar msg forward bo'lsa:
+    Agar msg forward bo'lsa (Bot API 7.0 forward_origin):
     - username bo'lsa: @username
-    - bo'lmasa: id:12345
+    - bo'lmasa: kanal/guruh nomi yoki id:12345
     - agar umuman aniqlanmasa: None
+    Eski forward_from* maydonlari o'qilmaydi — PTB 20.8 da ular deprecated va
+    Bot API 7.0 dan beri forward_origin har doim keladi.
     """
-    # PTB v20+: forward_origin
-    fo = getattr(msg, "forward_origin", None)
-    if fo:
-        # forwarded from user
-        su = getattr(fo, "sender_user", None)
-        if su:
-            if getattr(su, "username", None):
-                return f"@{su.username}"
-            return f"id:{su.id}"
-        # forwarded from chat/channel
-        sc = getattr(fo, "sender_chat", None)
-        if sc:
-            if getattr(sc, "username", None):
-                return f"@{sc.username}"
-            title = getattr(sc, "title", None)
-            return title or f"id:{sc.id}"
-        # hidden name (ba'zan)
-        sun = getattr(fo, "sender_user_name", None)
-        if sun:
-            return sun
-
-    # legacy fields
-    ff = getattr(msg, "forward_from", None)
-    if ff:
-        if getattr(ff, "username", None):
-            return f"@{ff.username}"
-        return f"id:{ff.id}"
-
-    fsn = getattr(msg, "forward_sender_name", None)
-    if fsn:
-        return fsn
-
-    fchat = getattr(msg, "forward_from_chat", None)
-    if fchat:
-        if getattr(fchat, "username", None):
-            return f"@{fchat.username}"
-        title = getattr(fchat, "title", None)
-        return title or f"id:{fchat.id}"
-
-    return None
+    fo = msg.forward_origin
+    if fo is None:
+        return None
+    # user / guruh nomidan / kanal
+    sender = getattr(fo, "sender_user", None) or getattr(fo, "sender_chat", None) or getattr(fo, "chat", None)
+    if sender is not None:
+        return _sender_credit(sender)
+    # yashirin user: faqat ism bor
+    return getattr(fo, "sender_user_name", None) or None
 
 def is_forwarded(msg) -> bool:
-    return bool(getattr(msg, "forward_origin", None) or getattr(msg, "forward_from", None) or getattr(msg, "forward_sender_name", None) or getattr(msg, "forward_from_chat", None))
+    return msg.forward_origin is not None
 
-def append_credit(text: str, msg) -> str:
-    credit = get_forward_credit(msg)
+def append_credit(text: str, post) -> str:
+    credit = post.credit
     if not credit:
         return text
     line = f"\n\n👤 Manba: {credit}"
-    # caption limit 1024 bo'lishi mumkin, shuning uchun keyin kesamiz
+    # caption limit 1024 bo'lishi mumkin — split_message bo'lib yuboradi
     return (text or "") + line
 
-# ============ MEDIA SENDER (single message) ============
-async def send_to_group_with_media(bot, dest_chat_id: int, thread_id: int, msg):
-    # agar forward bo'lib, kimligi ANIQLANMASA -> to'g'ridan-to'g'ri forward qilamiz
-    if is_forwarded(msg) and not get_forward_credit(msg):
-        await safe_forward_message(bot, dest_chat_id, SOURCE_CHAT_ID, msg.message_id, thread_id=thread_id)
-        return
+# ============ POST RECORD (yetkazish uchun kerakli minimum) ============
+class PostRecord:
+    """
+    Kanal postidan faqat yetkazishga keraklisi: id'lar, file_id, matn/caption, entities, kredit.
+    To'liq PTB Message o'rniga navbatlarda, albumlarda va PENDING'da shu saqlanadi.
+    kind: None — matn; "photo"/"video"/... — MEDIA_SENDERS; "other" — faqat copy_message (sticker, poll...).
+    """
 
-    caption = (msg.caption or msg.text or "")
-    caption = append_credit(caption, msg)
-    caption = caption[:1024] if caption else None
-    entities = msg.caption_entities or msg.entities
+    __slots__ = ("chat_id", "message_id", "media_group_id", "kind", "file_id", "file_unique_id",
+                 "text", "entities", "forwarded", "credit")
+
+    def __init__(self, chat_id: int, message_id: int, media_group_id: Optional[str] = None, kind: Optional[str] = None,
+                 file_id: Optional[str] = None, file_unique_id: Optional[str] = None, text: str = "",
+                 entities: tuple = (), forwarded: bool = False, credit: Optional[str] = None):
+        self.chat_id = chat_id
+        self.message_id = message_id
+        self.media_group_id = media_group_id
+        self.kind = kind
+        self.file_id = file_id
+        self.file_unique_id = file_unique_id
+        self.text = text
+        self.entities = entities
+        self.forwarded = forwarded
+        self.credit = credit
+
+    def to_dict(self) -> dict:
+        d = {k: getattr(self, k) for k in self.__slots__}
+        d["entities"] = [e.to_dict() for e in self.entities]
+        return d
+
+    @classmethod
+    def from_dict(cls, d: dict, bot=None) -> "PostRecord":
+        d = dict(d)
+        d["entities"] = tuple(MessageEntity.de_list(d.get("entities") or [], bot))
+        return cls(**d)
+
+def post_from_message(msg) -> PostRecord:
+    kind = media_kind(msg)
+    file_id = file_unique_id = None
+    if kind:
+        obj = msg.photo[-1] if kind == "photo" else getattr(msg, kind)
+        file_id, file_unique_id = obj.file_id, obj.file_unique_id
+    elif msg.text is None:
+        kind = "other"
+    if msg.text is not None:
+        text, entities = msg.text, msg.entities
+    else:
+        text, entities = msg.caption or "", msg.caption_entities
+    # forward manbasi shu yerda bir marta aniqlanadi; keyin faqat post.forwarded/post.credit
+    forwarded = is_forwarded(msg)
+    return PostRecord(
+        msg.chat_id, msg.message_id, msg.media_group_id, kind, file_id, file_unique_id,
+        text, tuple(entities or ()), forwarded, get_forward_credit(msg) if forwarded else None,
+    )
 
-    if msg.photo:
-        file_id = msg.photo[-1].file_id
-        await safe_send_photo(bot, dest_chat_id, file_id, thread_id=thread_id, caption=caption, caption_entities=entities)
-        return
-    if msg.video:
-        await safe_send_video(bot, dest_chat_id, msg.video.file_id, thread_id=thread_id, caption=caption, caption_entities=entities)
-        return
-    if msg.animation:
-        await safe_send_animation(bot, dest_chat_id, msg.animation.file_id, thread_id=thread_id, caption=caption, caption_entities=entities)
-        return
-    if msg.document:
-        await safe_send_document(bot, dest_chat_id, msg.document.file_id, thread_id=thread_id, caption=caption, caption_entities=entities)
-        return
-    if msg.voice:
-        await safe_send_voice(bot, dest_chat_id, msg.voice.file_id, thread_id=thread_id, caption=caption, caption_entities=entities)
-        return
-    if msg.audio:
-        await safe_send_audio(bot, dest_chat_id, msg.audio.file_id, thread_id=thread_id, caption=caption, caption_entities=entities)
-        return
+# ============ TEXT SPLITTER (UTF-16, entities bilan) ============
+# Bot API limitlari va entity offset/length UTF-16 birliklarida: emoji (BMP'dan tashqari) = 2.
+CAPTION_LIMIT = 1024
+TEXT_LIMIT = 4096
+_SPLIT_WS = " \t\r\n"
+
+def utf16_len(text: str) -> int:
+    return len(text.encode("utf-16-le")) // 2
+
+def _shift_entities(entities, start16: int, end16: int, lo: int) -> Tuple[tuple, int]:
+    """[start16, end16) oralig'iga tushgan entity'lar shu bo'lakka ko'chiriladi/kesiladi."""
+    # oldingi bo'laklarda tugaganlarini qayta ko'rmaymiz
+    while lo < len(entities) and entities[lo].offset + entities[lo].length <= start16:
+        lo += 1
+    out = []
+    for e in entities[lo:]:
+        if e.offset >= end16:
+            break
+        a, b = max(e.offset, start16), min(e.offset + e.length, end16)
+        if b <= a:
+            continue
+        if a == e.offset and b - a == e.length and start16 == 0:
+            out.append(e)
+        else:
+            out.append(MessageEntity(
+                e.type, a - start16, b - a,
+                url=e.url, user=e.user, language=e.language, custom_emoji_id=e.custom_emoji_id,
+            ))
+    return tuple(out), lo
 
-    text = (msg.text or msg.caption or "").strip()
-    text = append_credit(text, msg)
-    if text:
-        await safe_send_message(bot, dest_chat_id, text[:4096], thread_id=thread_id, entities=msg.entities)
+def split_message(text: str, entities=(), limit: int = TEXT_LIMIT, first_limit: Optional[int] = None) -> List[Tuple[str, tuple]]:
+    """
+    Matnni UTF-16 limitlarga sig'adigan bo'laklarga ajratadi: [(matn, entities), ...].
+    Kesish joyi — bo'lakning ikkinchi yarmidagi oxirgi qator oxiri, bo'lmasa bo'sh joy,
+    bo'lmasa qattiq kesish. Bo'lak chetidagi bo'shliqlar tashlanadi. Bitta o'tish (O(n)):
+    har bo'lak matndan faqat bir marta kesib olinadi.
+    """
+    text = text or ""
+    bounds = []  # (start, end, start16, end16)
+    start = start16 = pos16 = 0
+    lim = first_limit or limit
+    nl = sp = None  # (char_idx, utf16_idx) — oxirgi qator oxiri / bo'sh joydan keyingi pozitsiya
+    for i, ch in enumerate(text):
+        w = 2 if ord(ch) > 0xFFFF else 1
+        while pos16 + w - start16 > lim:
+            if nl and nl[0] > start and lim // 2 <= nl[1] - start16 <= lim:
+                cut = nl
+            elif sp and sp[0] > start and sp[1] - start16 <= lim:
+                cut = sp
+            else:
+                # qattiq kesish: start'dan lim gacha sig'adigan joy (har belgi ko'pi bilan 2 marta ko'riladi)
+                j, j16 = start, start16
+                while j < i and j16 + (2 if ord(text[j]) > 0xFFFF else 1) - start16 <= lim:
+                    j16 += 2 if ord(text[j]) > 0xFFFF else 1
+                    j += 1
+                cut = (j, j16) if j > start else (i, pos16)
+            bounds.append((start, cut[0], start16, cut[1]))
+            start, start16 = cut
+            lim = limit
+            if nl and nl[0] <= start:
+                nl = None
+            if sp and sp[0] <= start:
+                sp = None
+        pos16 += w
+        if ch == "\n":
+            nl = (i + 1, pos16)
+        elif ch in _SPLIT_WS:
+            sp = (i + 1, pos16)
+    bounds.append((start, len(text), start16, pos16))
+
+    ents = sorted(entities or (), key=lambda e: e.offset)
+    chunks, lo = [], 0
+    for a, b, a16, b16 in bounds:
+        # chetdagi bo'shliqlar (hammasi BMP — 1 birlik) tashlanadi, offsetlar mos siljiydi
+        while a < b and text[a] in _SPLIT_WS:
+            a += 1
+            a16 += 1
+        while b > a and text[b - 1] in _SPLIT_WS:
+            b -= 1
+            b16 -= 1
+        if a == b:
+            continue
+        chunk_ents, lo = _shift_entities(ents, a16, b16, lo)
+        chunks.append((text[a:b], chunk_ents))
+    return chunks
+
+async def send_followups(bot, chat_id: int, thread_id: Optional[int], chunks: List[Tuple[str, tuple]]):
+    """Caption/matnga sig'magan qism — shu thread'ga ketma-ket xabarlar."""
+    for text, entities in chunks:
+        await safe_call(bot, "send_message", chat_id, thread_id, text=text, entities=entities)
+
+# ============ MEDIA SENDER (single message) ============
+async def copy_to_group(bot, dest_chat_id: int, thread_id: int, post: PostRecord):
+    """
+    copy_message: formatlash, spoiler va har qanday media turi saqlanadi.
+    Kredit kerak bo'lsa faqat caption almashtiriladi. Qila olmasak None.
+    """
+    if not post.credit:
+        return await safe_call(bot, "copy_message", dest_chat_id, thread_id, from_chat_id=post.chat_id, message_id=post.message_id)
+    if post.kind is None:
+        return None  # matnni copy_message bilan o'zgartirib bo'lmaydi
+    chunks = split_message(append_credit(post.text, post), post.entities, TEXT_LIMIT, CAPTION_LIMIT)
+    caption, caption_entities = chunks[0] if chunks else ("", ())
+    res = await safe_call(
+        bot, "copy_message", dest_chat_id, thread_id,
+        from_chat_id=post.chat_id, message_id=post.message_id,
+        caption=caption, caption_entities=caption_entities,
+    )
+    await send_followups(bot, dest_chat_id, thread_id, chunks[1:])
+    return res
+
+async def send_to_group_with_media(bot, dest_chat_id: int, thread_id: int, post: PostRecord):
+    """Guruhga yuboradi; Bot API natijasini qaytaradi (message_id kerak bo'lganlar uchun)."""
+    # agar forward bo'lib, kimligi ANIQLANMASA -> to'g'ridan-to'g'ri forward qilamiz
+    if post.forwarded and not post.credit:
+        return await safe_call(bot, "forward_message", dest_chat_id, thread_id, from_chat_id=post.chat_id, message_id=post.message_id)
+
+    if STATE.get("copy_mode", True) or post.kind == "other":
+        try:
+            res = await copy_to_group(bot, dest_chat_id, thread_id, post)
+            if res is not None:
+                return res
+        except RetryAfter:
+            raise
+        except BadRequest as e:
+            log.warning("copy_message failed, re-upload: %s", e)
+
+    text = append_credit(post.text, post)
+    if post.kind in MEDIA_SENDERS:
+        chunks = split_message(text, post.entities, TEXT_LIMIT, CAPTION_LIMIT)
+        caption, caption_entities = chunks[0] if chunks else (None, None)
+        res = await safe_send_media(bot, dest_chat_id, post.kind, post.file_id, thread_id=thread_id, caption=caption, caption_entities=caption_entities)
+        await send_followups(bot, dest_chat_id, thread_id, chunks[1:])
+        return res
+
+    chunks = split_message(text, post.entities, TEXT_LIMIT)
+    if not chunks:
+        return None
+    res = await safe_call(bot, "send_message", dest_chat_id, thread_id, text=chunks[0][0], entities=chunks[0][1])
+    await send_followups(bot, dest_chat_id, thread_id, chunks[1:])
+    return res
 
 # ============ ALBUM (media_group) BUFFER ============
-ALBUMS: Dict[str, Dict] = {}  # key -> {"msgs":[...], "task": asyncio.Task}
+ALBUMS: Dict[str, Dict] = {}  # key -> {"msgs":[PostRecord...], "event": asyncio.Event, "started": float, "task": asyncio.Task}
+ALBUM_IDLE_SEC = 0.6       # oxirgi elementdan keyin shuncha jimlik bo'lsa -> yuboramiz
+ALBUM_MAX_WAIT_SEC = 3.0   # birinchi elementdan keyin eng ko'p kutish
+ALBUM_MAX_ITEMS = 10       # Telegram media group limiti
 
-def album_key(msg) -> Optional[str]:
-    mgid = getattr(msg, "media_group_id", None)
+# kech kelgan qismlar ham o'sha thread'ga tushsin: key -> thread_id
+RECENT_ALBUM_THREADS: "OrderedDict[str, int]" = OrderedDict()
+RECENT_ALBUM_THREADS_MAX = 256
+
+def album_key(post) -> Optional[str]:
+    mgid = getattr(post, "media_group_id", None)
     if not mgid:
         return None
-    return f"{msg.chat_id}:{mgid}"
+    return f"{post.chat_id}:{mgid}"
+
+# send_media_group: foto+video aralash bo'lishi mumkin, hujjat va audio faqat o'z turi bilan
+MEDIA_GROUP_FAMILY = {"photo": "visual", "video": "visual", "document": "document", "audio": "audio"}
+INPUT_MEDIA = {
+    "photo": (InputMediaPhoto, {}),
+    "video": (InputMediaVideo, {"supports_streaming": True}),
+    "document": (InputMediaDocument, {}),
+    "audio": (InputMediaAudio, {}),
+}
 
-def can_make_media_group(msgs) -> bool:
-    for m in msgs:
-        if not (m.photo or m.video):
-            return False
-    return True
+def media_groups(posts: List[PostRecord]) -> List[List[PostRecord]]:
+    """Albumni tartibni buzmasdan birga yuborsa bo'ladigan ketma-ket bo'laklarga ajratadi."""
+    groups: List[List[PostRecord]] = []
+    prev = None
+    for p in posts:
+        family = MEDIA_GROUP_FAMILY.get(p.kind)
+        if family is not None and family == prev:
+            groups[-1].append(p)
+        else:
+            groups.append([p])
+        prev = family
+    return groups
 
-async def flush_album(app: Application, key: str, delay_sec: float = 1.2):
-    await asyncio.sleep(delay_sec)
+def add_album_item(app: Application, key: str, msg: PostRecord):
+    pack = ALBUMS.get(key)
+    if not pack:
+        pack = ALBUMS[key] = {"msgs": [msg], "event": asyncio.Event(), "started": time.monotonic()}
+        pack["task"] = asyncio.create_task(collect_album(app, key))
+    else:
+        pack["msgs"].append(msg)
+        pack["event"].set()
+
+async def collect_album(app: Application, key: str) -> Optional[asyncio.Future]:
+    """Har yangi elementda idle taymer qayta boshlanadi; 10 ta bo'lsa yoki max kutish tugasa — flush."""
+    pack = ALBUMS.get(key)
+    if not pack:
+        return None
+    deadline = pack["started"] + ALBUM_MAX_WAIT_SEC
+    while len(pack["msgs"]) < ALBUM_MAX_ITEMS:
+        timeout = min(ALBUM_IDLE_SEC, deadline - time.monotonic())
+        if timeout <= 0:
+            break
+        try:
+            await asyncio.wait_for(pack["event"].wait(), timeout)
+        except asyncio.TimeoutError:
+            break
+        pack["event"].clear()
+    return await flush_album(app, key)
+
+async def flush_album(app: Application, key: str) -> Optional[asyncio.Future]:
     pack = ALBUMS.pop(key, None)
     if not pack:
-        return
+        return None
     msgs = pack["msgs"]
     msgs.sort(key=lambda x: x.message_id)
 
-    first = msgs[0]
-    text = (first.caption or first.text or "").strip()
-    topic_key = guess_topic_key(text)
-    thread_id = topic_thread_id(topic_key)
-
-    # agar album forward bo'lib, kimligi ANIQLANMASA -> albumni bittalab forward qilib yuboramiz
-    if is_forwarded(first) and not get_forward_credit(first):
-        for m in msgs:
-            await safe_forward_message(app.bot, DEST_CHAT_ID, SOURCE_CHAT_ID, m.message_id, thread_id=thread_id)
-        return
+    started = pack.get("started")
+    if started is not None:
+        sec = time.monotonic() - started
+        ALBUM_ASSEMBLY_SECONDS.observe(sec)
+        log.debug("Album %s: %s ta element, %.0f ms", key, len(msgs), sec * 1000)
+    ALBUM_SIZE.observe(len(msgs))
 
-    if can_make_media_group(msgs):
-        media = []
-        cap = (first.caption or "").strip()
-        cap = append_credit(cap, first)
-        cap = cap[:1024] if cap else None
-        cap_entities = first.caption_entities
-
-        for i, m in enumerate(msgs):
-            if m.photo:
-                file_id = m.photo[-1].file_id
-                if i == 0 and cap:
-                    media.append(InputMediaPhoto(media=file_id, caption=cap, caption_entities=cap_entities))
-                else:
-                    media.append(InputMediaPhoto(media=file_id))
-            elif m.video:
-                file_id = m.video.file_id
-                if i == 0 and cap:
-                    media.append(InputMediaVideo(media=file_id, caption=cap, caption_entities=cap_entities, supports_streaming=True))
-                else:
-                    media.append(InputMediaVideo(media=file_id, supports_streaming=True))
+    dup, entry = dedup_check(msgs)
+    if dup:
+        await handle_duplicate(app, entry, msgs)
+        return None
 
-        try:
-            await safe_send_media_group(app.bot, DEST_CHAT_ID, media, thread_id=thread_id)
-            return
-        except Exception as e:
-            log.warning("send_media_group failed, fallback to singles: %s", e)
+    futs = []
+    for route in routes_for(msgs[0].chat_id):
+        rkey = f"{route.idx}|{key}"
+        thread_id = RECENT_ALBUM_THREADS.get(rkey)
+        if thread_id is None:
+            topic_key = guess_topic_key(msgs[0].text, route)
+            POSTS_ROUTED.inc(topic_key)
+            thread_id = RECENT_ALBUM_THREADS[rkey] = route.thread_id(topic_key)
+            if len(RECENT_ALBUM_THREADS) > RECENT_ALBUM_THREADS_MAX:
+                RECENT_ALBUM_THREADS.popitem(last=False)
+
+        # 10 tadan ko'p bo'lsa — bir nechta media group (navbat tartibi saqlanadi)
+        for i in range(0, len(msgs), ALBUM_MAX_ITEMS):
+            chunk = msgs[i:i + ALBUM_MAX_ITEMS]
+            futs.append(SENDER.submit(
+                route.dest,
+                lambda chunk=chunk, dest=route.dest, thread_id=thread_id: deliver_album(app.bot, dest, thread_id, chunk),
+                f"album {key} -> {route.name}",
+            ))
+            if i == 0:
+                remember_sent(entry, route.idx, thread_id, futs[-1])
+    if not futs:
+        return None
+    return ack_when_done(asyncio.gather(*futs), msgs)
 
-    for m in msgs:
-        await send_to_group_with_media(app.bot, DEST_CHAT_ID, thread_id, m)
+async def deliver_album(bot, dest_chat_id: int, thread_id: int, posts: List[PostRecord]):
+    first = posts[0]
+
+    # agar album forward bo'lib, kimligi ANIQLANMASA -> bitta forward_messages (album bo'lib qoladi)
+    if first.forwarded and not first.credit:
+        try:
+            return await safe_call(bot, "forward_messages", dest_chat_id, thread_id, from_chat_id=first.chat_id, message_ids=[p.message_id for p in posts])
+        except RetryAfter:
+            raise
+        except BadRequest as e:
+            log.warning("forward_messages failed, bittalab forward: %s", e)
+        sent = []
+        for p in posts:
+            sent.append(await safe_call(bot, "forward_message", dest_chat_id, thread_id, from_chat_id=p.chat_id, message_id=p.message_id))
+        return sent
+
+    # kredit kerak bo'lmasa butun album bitta copy_messages bilan (N -> 1 chaqiruv)
+    if STATE.get("copy_mode", True) and not first.credit:
+        try:
+            return await safe_call(bot, "copy_messages", dest_chat_id, thread_id, from_chat_id=first.chat_id, message_ids=[p.message_id for p in posts])
+        except RetryAfter:
+            raise
+        except BadRequest as e:
+            log.warning("copy_messages failed, re-upload: %s", e)
+
+    # qayta yuborish: mos turlar media group bo'lib, qolganlari bittalab.
+    # Topic ichida tartib saqlanishi uchun bo'laklar ketma-ket yuboriladi.
+    chunks = split_message(append_credit(first.text, first), first.entities, TEXT_LIMIT, CAPTION_LIMIT)
+    cap, cap_entities = chunks[0] if chunks else (None, None)
+    followups = chunks[1:]
+    sent = []
+    for group in media_groups(posts):
+        if len(group) > 1:
+            media = []
+            for p in group:
+                cls, extra = INPUT_MEDIA[p.kind]
+                kw = {"caption": cap, "caption_entities": cap_entities} if p is first and cap else {}
+                media.append(cls(media=p.file_id, **extra, **kw))
+            try:
+                sent.append(await safe_call(bot, "send_media_group", dest_chat_id, thread_id, media=media))
+                continue
+            except RetryAfter:
+                raise  # SENDER.call kutib urinib ko'rdi — singles bilan ko'paytirmaymiz
+            except Exception as e:
+                log.warning("send_media_group failed, fallback to singles: %s", e)
+        for p in group:
+            sent.append(await send_to_group_with_media(bot, dest_chat_id, thread_id, p))
+            if p is first:
+                followups = []  # birinchi element o'z caption'ini o'zi bo'lib yubordi
+    await send_followups(bot, dest_chat_id, thread_id, followups)
+    return sent
 
 # ============ “MANUAL MODE” uchun pending ============
-PENDING: Dict[int, Dict] = {}  # channel_msg_id -> data
+PENDING_MAX = int((os.getenv("PENDING_MAX") or "500").strip() or "500")
+PENDING_TTL_SEC = float((os.getenv("PENDING_TTL_SEC") or "1800").strip() or "1800")
+PENDING_SPILL = (os.getenv("PENDING_SPILL") or "1").strip().lower() in ("1", "true", "yes")
+PENDING_SWEEP_SEC = 30.0
+
+class PendingStore:
+    """
+    Admin tanlovini kutayotgan postlar: "route_idx:channel_msg_id" -> {"post", "route", "ts", "previews"}.
+    previews — adminlarga yuborilgan preview'lar: [(admin_id, message_id), ...].
+    Faqat PostRecord saqlanadi. Hajm chegarasidan oshgani yoki TTL'i o'tgani
+    guess_topic_key bo'yicha avtomatik yuboriladi. spill=True bo'lsa WAL bazasidagi
+    `pending` jadvaliga ham yoziladi — restartda navbat tiklanadi.
+    """
+
+    def __init__(self, max_items: int = PENDING_MAX, ttl: float = PENDING_TTL_SEC, spill: bool = PENDING_SPILL):
+        self.max_items = max_items
+        self.ttl = ttl
+        self.spill = spill
+        self.items: "OrderedDict[str, dict]" = OrderedDict()
+
+    def __len__(self) -> int:
+        return len(self.items)
+
+    def __contains__(self, key: str) -> bool:
+        return key in self.items
+
+    def _db(self) -> Optional[sqlite3.Connection]:
+        return POSTLOG.db if self.spill else None
+
+    def add(self, key: str, route_idx: int, post: PostRecord) -> List[dict]:
+        """Qo'shadi; hajmdan oshib chiqarib yuborilganlarni qaytaradi (auto yuborish uchun)."""
+        item = {"post": post, "route": route_idx, "ts": time.time(), "previews": []}
+        self.items[key] = item
+        self.items.move_to_end(key)
+        db = self._db()
+        if db is not None:
+            db.execute(
+                "INSERT OR REPLACE INTO pending (key, route, ts, record) VALUES (?, ?, ?, ?)",
+                (key, route_idx, item["ts"], json.dumps(post.to_dict(), ensure_ascii=False)),
+            )
+        overflow = []
+        while len(self.items) > self.max_items:
+            overflow.append(self.pop(next(iter(self.items))))
+        return overflow
+
+    def set_previews(self, key: str, previews: List[Tuple[int, int]]):
+        item = self.items.get(key)
+        if item is None:
+            return
+        item["previews"] = previews
+        db = self._db()
+        if db is not None:
+            db.execute("UPDATE pending SET previews = ? WHERE key = ?", (json.dumps(previews), key))
+
+    def pop(self, key: str) -> Optional[dict]:
+        item = self.items.pop(key, None)
+        db = self._db()
+        if item is not None and db is not None:
+            db.execute("DELETE FROM pending WHERE key = ?", (key,))
+        return item
+
+    def expired(self) -> List[dict]:
+        cutoff = time.time() - self.ttl
+        out = []
+        while self.items:
+            key, item = next(iter(self.items.items()))
+            if item["ts"] > cutoff:
+                break
+            out.append(self.pop(key))
+        return out
+
+    def load(self, bot=None):
+        db = self._db()
+        if db is None:
+            return
+        for key, route_idx, ts, record, previews in db.execute("SELECT key, route, ts, record, previews FROM pending ORDER BY ts"):
+            if route_idx < len(ROUTES):
+                self.items[key] = {
+                    "post": PostRecord.from_dict(json.loads(record), bot),
+                    "route": route_idx,
+                    "ts": ts,
+                    "previews": [tuple(p) for p in json.loads(previews or "[]")],
+                }
+            else:
+                db.execute("DELETE FROM pending WHERE key = ?", (key,))
+
+PENDING = PendingStore()
+
+# WAL kaliti -> [tugamagan yuborishlar, hammasi muvaffaqiyatlimi]
+_DELIVERIES: Dict[tuple, list] = {}
+
+def pending_routes(post: PostRecord) -> Set[int]:
+    """Post qaysi route'larda hali admin tanlovini kutyapti (PENDING'da)."""
+    return {r.idx for r in routes_for(post.chat_id) if f"{r.idx}:{post.message_id}" in PENDING}
+
+def ack_when_delivered(fut: asyncio.Future, post: PostRecord) -> asyncio.Future:
+    """
+    Bitta postning yuborishlari (auto route'lar, admin tanlovi, TTL) uchun WAL ack:
+    barcha yuborishlar tugab, PENDING'da route qolmagandagina. Shungacha status 0 —
+    crash yoki drain timeout'da post yo'qolmaydi (replay PENDING'dagilarni o'tkazib yuboradi).
+    """
+    key = (post.chat_id, post.message_id)
+    state = _DELIVERIES.setdefault(key, [0, True])
+    state[0] += 1
+
+    def done(f: asyncio.Future):
+        state[0] -= 1
+        if f.cancelled():
+            return  # shutdown: pending qoladi -> replay
+        state[1] = state[1] and f.exception() is None
+        if state[0] == 0 and not pending_routes(post):
+            _DELIVERIES.pop(key, None)
+            POSTLOG.ack([key], ok=state[1])
+
+    fut.add_done_callback(done)
+    return fut
+
+# kim qaysi postni qayerga yuborgani — kech bosgan adminga ko'rsatish uchun
+DECIDED: "OrderedDict[str, str]" = OrderedDict()
+DECIDED_MAX = 1000
+
+def remember_decision(pkey: str, text: str):
+    DECIDED[pkey] = text
+    DECIDED.move_to_end(pkey)
+    while len(DECIDED) > DECIDED_MAX:
+        DECIDED.popitem(last=False)
+
+async def send_previews(bot, text: str, reply_markup) -> List[Tuple[int, int]]:
+    """Preview barcha adminlarga parallel yuboriladi; yetib borganlari [(admin_id, message_id)]."""
+    results = await asyncio.gather(
+        *(bot.send_message(chat_id=admin_id, text=text, reply_markup=reply_markup) for admin_id in ADMIN_IDS),
+        return_exceptions=True,
+    )
+    sent = []
+    for admin_id, res in zip(ADMIN_IDS, results):
+        if isinstance(res, BaseException):
+            log.warning("Admin %s ga preview yuborilmadi: %s", admin_id, res)
+        else:
+            sent.append((admin_id, res.message_id))
+    return sent
+
+async def close_previews(bot, previews: List[Tuple[int, int]], text: str, skip: Optional[int] = None):
+    """Qolgan adminlarning preview'larini yakuniy matnga almashtiradi (tugmalar olib tashlanadi)."""
+    await asyncio.gather(
+        *(bot.edit_message_text(chat_id=admin_id, message_id=mid, text=text)
+          for admin_id, mid in previews if admin_id != skip),
+        return_exceptions=True,
+    )
+
+def auto_route_pending(app: Application, item: dict):
+    """Admin javob bermagan post: guess_topic_key bo'yicha yuboriladi."""
+    route, post = ROUTES[item["route"]], item["post"]
+    topic_key = guess_topic_key(post.text, route)
+    POSTS_ROUTED.inc(topic_key)
+    thread_id = route.thread_id(topic_key)
+    log.info("Pending post %s javobsiz qoldi -> auto: %s", post.message_id, topic_key)
+    fut = SENDER.submit(route.dest, lambda: send_to_group_with_media(app.bot, route.dest, thread_id, post), f"post {post.message_id} -> {route.name}")
+    ack_when_delivered(fut, post)
+    if item.get("previews"):
+        done = f"⏱ Javob bo‘lmadi, avtomatik yuborildi: {route.label(topic_key)}"
+        remember_decision(f"{route.idx}:{post.message_id}", done)
+        asyncio.create_task(close_previews(app.bot, item["previews"], done))
+
+async def pending_sweeper(app: Application):
+    while True:
+        await asyncio.sleep(PENDING_SWEEP_SEC)
+        for item in PENDING.expired():
+            auto_route_pending(app, item)
 
 async def start_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if not update.effective_user or not update.message:
@@ -442,6 +1846,167 @@ async def admin_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
         return
     await update.message.reply_text("🛠 Admin panel:", reply_markup=admin_panel_kb())
 
+# ============ KEYWORD EDITING (restartsiz) ============
+# Tahrir copy-on-write: yangi dict yasaladi, classifier thread'da quriladi va bitta
+# qadamda almashtiriladi — ishlov berilayotgan postlar eski (to'liq) matcher'ni ko'radi.
+KW_HELP = (
+    "Tahrirlash:\n"
+    "/kw_add topic so‘z1, so‘z2\n"
+    "/kw_del topic so‘z1, so‘z2\n"
+    "Ko‘p so‘z: .json ({\"topic\": [\"so‘z\", ...]}) yoki .txt (topic: so‘z1, so‘z2) faylni "
+    "\"/kw_import\" (yoki \"/kw_import replace\") izohi bilan yuboring."
+)
+KW_IMPORT_MAX_BYTES = 1 << 20
+_KEYWORDS_LOCK = asyncio.Lock()
+
+def _split_words(text: str) -> List[str]:
+    return [w.strip() for w in re.split(r"[,\n]", text or "") if w.strip()]
+
+def _merge_words(words: List[str], add: List[str]) -> List[str]:
+    seen = {clean_text_for_match(w) for w in words}
+    out = list(words)
+    for w in add:
+        key = clean_text_for_match(w)
+        if key and key not in seen:
+            seen.add(key)
+            out.append(w)
+    return out
+
+async def swap_keywords(change) -> Dict[str, List[str]]:
+    """
+    change(eski_keywords) -> yangi dict (eskisi o'zgartirilmaydi). Matcher fonda quriladi,
+    STATE["keywords"] va route classifier'lari bir vaqtda almashtiriladi, keyin saqlanadi.
+    """
+    async with _KEYWORDS_LOCK:
+        new_kw = change(STATE.get("keywords") or {})
+        weights = STATE.get("weights")
+        clf = await asyncio.to_thread(KeywordClassifier, new_kw, weights)
+        STATE["keywords"] = new_kw
+        # dict almashgani get_matcher uchun yetarli; version oshirilmaydi — boshqa route'lar qayta qurilmaydi
+        save_state(bump_version=False)
+        for route in ROUTES:
+            if route.keywords is None:
+                route._clf = clf
+                route._clf_src = (state_version(), new_kw, weights)
+        return new_kw
+
+def _kw_topic_args(args: List[str]) -> tuple:
+    if len(args) < 2 or args[0] not in primary_route().topics:
+        return None, []
+    return args[0], _split_words(" ".join(args[1:]))
+
+def parse_keywords_file(raw: bytes, name: str) -> Dict[str, List[str]]:
+    """.json: {"topic": [...]} ; boshqasi: har qatorda "topic: so'z1, so'z2"."""
+    text = raw.decode("utf-8-sig")
+    out: Dict[str, List[str]] = {}
+    if name.lower().endswith(".json"):
+        data = json.loads(text)
+        if not isinstance(data, dict):
+            raise ValueError("JSON obyekt bo‘lishi kerak")
+        for k, words in data.items():
+            if isinstance(words, str):
+                words = _split_words(words)
+            out[str(k)] = [str(w).strip() for w in words if str(w).strip()]
+        return out
+    for line in text.splitlines():
+        topic_key, sep, rest = line.partition(":")
+        if sep and topic_key.strip() and not line.lstrip().startswith("#"):
+            out.setdefault(topic_key.strip(), []).extend(_split_words(rest))
+    return out
+
+async def _admin_guard(update: Update) -> bool:
+    if not update.effective_user or not update.message:
+        return False
+    if not is_admin(update.effective_user.id):
+        await update.message.reply_text("⛔ Siz admin emassiz.")
+        return False
+    return True
+
+async def kw_add_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if not await _admin_guard(update):
+        return
+    topic_key, words = _kw_topic_args(context.args or [])
+    if not topic_key or not words:
+        await update.message.reply_text("Topic: " + ", ".join(primary_route().topics) + "\n\n" + KW_HELP)
+        return
+    new_kw = await swap_keywords(lambda kw: {**kw, topic_key: _merge_words(kw.get(topic_key, []), words)})
+    await update.message.reply_text(f"✅ {primary_route().label(topic_key)}: {len(new_kw[topic_key])} ta so‘z")
+
+async def kw_del_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if not await _admin_guard(update):
+        return
+    topic_key, words = _kw_topic_args(context.args or [])
+    if not topic_key or not words:
+        await update.message.reply_text("Topic: " + ", ".join(primary_route().topics) + "\n\n" + KW_HELP)
+        return
+    drop = {clean_text_for_match(w) for w in words}
+    new_kw = await swap_keywords(
+        lambda kw: {**kw, topic_key: [w for w in kw.get(topic_key, []) if clean_text_for_match(w) not in drop]}
+    )
+    await update.message.reply_text(f"✅ {primary_route().label(topic_key)}: {len(new_kw[topic_key])} ta so‘z")
+
+async def kw_import_doc(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if not await _admin_guard(update):
+        return
+    doc = update.message.document
+    if not doc or (doc.file_size or 0) > KW_IMPORT_MAX_BYTES:
+        await update.message.reply_text("⛔ Fayl juda katta (1 MB gacha).")
+        return
+    replace = "replace" in (update.message.caption or "").split()
+    try:
+        f = await doc.get_file()
+        data = parse_keywords_file(bytes(await f.download_as_bytearray()), doc.file_name or "")
+    except Exception as e:
+        await update.message.reply_text(f"⛔ Faylni o‘qib bo‘lmadi: {e}")
+        return
+    topics = primary_route().topics
+    unknown = [k for k in data if k not in topics]
+    data = {k: v for k, v in data.items() if k in topics}
+    if not data:
+        await update.message.reply_text("⛔ Faylda mos topic topilmadi.\n\n" + KW_HELP)
+        return
+
+    def change(kw):
+        new_kw = dict(kw)
+        for k, words in data.items():
+            new_kw[k] = _merge_words([] if replace else kw.get(k, []), words)
+        return new_kw
+
+    new_kw = await swap_keywords(change)
+    lines = [f"{primary_route().label(k)}: {len(new_kw[k])}" for k in data]
+    if unknown:
+        lines.append("O‘tkazib yuborildi: " + ", ".join(unknown))
+    await update.message.reply_text("✅ Import qilindi\n" + "\n".join(lines))
+
+def stats_text() -> str:
+    DECISIONS.flush(POSTLOG.db)
+    route = primary_route()
+    parts = ["📊 Routing statistikasi"]
+    for title, hours in STATS_WINDOWS:
+        st = DECISIONS.summary(POSTLOG.db, hours)
+        if not st["total"]:
+            parts.append(f"\n⏱ {title}: post yo‘q")
+            continue
+        parts.append(
+            f"\n⏱ {title}: {st['total']} post | default’ga: {st['fallback'] / st['total'] * 100:.1f}%"
+            f" | o‘rtacha {st['avg_chars']:.0f} belgi, {st['avg_ms']:.2f} ms"
+        )
+        parts.append("  " + " · ".join(f"{route.label(t)} {n}" for t, n in st["topics"]))
+        if st["keywords"]:
+            parts.append("  🔑 " + ", ".join(f"{k} {n}" for k, n in st["keywords"]))
+    if DECISIONS.dropped:
+        parts.append(f"\n⚠️ Buferdan tushib qolgan: {DECISIONS.dropped}")
+    return "\n".join(parts)
+
+async def stats_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if not await _admin_guard(update):
+        return
+    if POSTLOG.db is None:
+        await update.message.reply_text("Statistika hali tayyor emas.")
+        return
+    for chunk, _ in split_message(stats_text(), (), TEXT_LIMIT):
+        await update.message.reply_text(chunk)
+
 async def admin_cb(update: Update, context: ContextTypes.DEFAULT_TYPE):
     q = update.callback_query
     if not q or not q.from_user:
@@ -458,22 +2023,21 @@ async def admin_cb(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await q.edit_message_reply_markup(reply_markup=admin_panel_kb())
         return
 
+    if data == "adm:toggle_copy":
+        STATE["copy_mode"] = not STATE.get("copy_mode", True)
+        save_state()
+        await q.answer("OK")
+        await q.edit_message_reply_markup(reply_markup=admin_panel_kb())
+        return
+
     if data == "adm:set_default":
         await q.answer("OK")
-        kb = InlineKeyboardMarkup([
-            [InlineKeyboardButton("💬 Umumiy", callback_data="def:umumiy"), InlineKeyboardButton("🏠 Uy", callback_data="def:uy")],
-            [InlineKeyboardButton("💼 Ish", callback_data="def:ish"), InlineKeyboardButton("🚖 Taksi", callback_data="def:taksi")],
-            [InlineKeyboardButton("🛂 Visa", callback_data="def:visa"), InlineKeyboardButton("🛒 Bozor", callback_data="def:bozor")],
-            [InlineKeyboardButton("🕌 Ziyorat", callback_data="def:ziyorat"), InlineKeyboardButton("🩺 Salomatlik", callback_data="def:salomatlik")],
-            [InlineKeyboardButton("📣 E’lon", callback_data="def:elon")],
-            [InlineKeyboardButton("⬅️ Orqaga", callback_data="adm:back")],
-        ])
-        await q.edit_message_text("Default bo‘limni tanlang:", reply_markup=kb)
+        await q.edit_message_text("Default bo‘limni tanlang:", reply_markup=default_topic_kb(primary_route()))
         return
 
     if data.startswith("def:"):
         topic_key = data.split(":", 1)[1]
-        if topic_key in TOPICS:
+        if topic_key in primary_route().topics:
             STATE["default_topic"] = topic_key
             save_state()
         await q.answer("✅ Saqlandi")
@@ -485,14 +2049,14 @@ async def admin_cb(update: Update, context: ContextTypes.DEFAULT_TYPE):
         lines = []
         for k, words in kw.items():
             lines.append(f"{TOPIC_LABELS_UZ.get(k,k)}: {', '.join(words[:20])}{'…' if len(words)>20 else ''}")
-        text = "🧠 Keywords:\n\n" + "\n".join(lines)
+        text = "🧠 Keywords:\n\n" + "\n".join(lines) + "\n\n" + KW_HELP
         await q.answer("OK")
-        await q.message.reply_text(text[:4096])
+        for chunk, _ in split_message(text, (), TEXT_LIMIT):
+            await q.message.reply_text(chunk)
         return
 
     if data == "adm:reset_keywords":
-        STATE["keywords"] = DEFAULT_KEYWORDS
-        save_state()
+        await swap_keywords(lambda kw: copy_keywords(DEFAULT_KEYWORDS))
         await q.answer("✅ Qaytarildi")
         await q.edit_message_reply_markup(reply_markup=admin_panel_kb())
         return
@@ -507,98 +2071,504 @@ async def admin_cb(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
     if data.startswith("pick:"):
         parts = data.split(":")
-        if len(parts) != 3:
+        if len(parts) != 4 or not parts[1].isdigit() or int(parts[1]) >= len(ROUTES):
             await q.answer("Xato", show_alert=True)
             return
-        ch_msg_id = int(parts[1])
-        topic_key = parts[2]
-        pend = PENDING.get(ch_msg_id)
+        route = ROUTES[int(parts[1])]
+        pkey = f"{parts[1]}:{parts[2]}"
+        topic_key = parts[3]
+        # birinchi bosgan admin yutadi, ikkinchisi bo'sh qaytadi. Qulf kerak emas: pop va
+        # remember_decision orasida await yo'q — event loop'da bu qadam bo'linmaydi
+        pend = PENDING.pop(pkey)
+        if pend:
+            user = q.from_user
+            who = f"@{user.username}" if user.username else user.full_name
+            done = f"✅ {who} yubordi: {route.label(topic_key)}"
+            remember_decision(pkey, done)
         if not pend:
-            await q.answer("Bu post topilmadi (eskirib ketgan).", show_alert=True)
+            done = DECIDED.get(pkey)
+            await q.answer(done or "Bu post topilmadi (eskirib ketgan).", show_alert=True)
+            if done:
+                try:
+                    await q.edit_message_text(done)
+                except Exception:
+                    pass
             return
 
-        msg = pend["msg"]
-        thread_id = topic_thread_id(topic_key)
-        await send_to_group_with_media(context.bot, DEST_CHAT_ID, thread_id, msg)
-        PENDING.pop(ch_msg_id, None)
+        post = pend["post"]
+        POSTS_ROUTED.inc(topic_key)
+        thread_id = route.thread_id(topic_key)
+        fut = SENDER.submit(route.dest, lambda: send_to_group_with_media(context.bot, route.dest, thread_id, post), f"post {pkey} -> {route.name}")
+        ack_when_delivered(fut, post)
 
         await q.answer("✅ Yuborildi")
         try:
-            await q.edit_message_text(f"✅ Yuborildi: {TOPIC_LABELS_UZ.get(topic_key, topic_key)}")
+            await q.edit_message_text(done)
         except Exception:
             pass
+        await close_previews(context.bot, pend.get("previews") or [], done, skip=user.id)
         return
 
+class KeyedSequencer:
+    """
+    concurrent_updates yoqilganda: bir xil kalit (source chat) bo'yicha update'lar kelgan
+    tartibda ketma-ket, turli kalitlar esa parallel ishlanadi. asyncio.Lock navbati FIFO.
+    """
+
+    def __init__(self):
+        self.locks: Dict[Hashable, asyncio.Lock] = {}
+        self.users: Dict[Hashable, int] = {}
+
+    @contextlib.asynccontextmanager
+    async def hold(self, key: Hashable):
+        lock = self.locks.get(key)
+        if lock is None:
+            lock = self.locks[key] = asyncio.Lock()
+        self.users[key] = self.users.get(key, 0) + 1
+        try:
+            async with lock:
+                yield
+        finally:
+            self.users[key] -= 1
+            if not self.users[key]:
+                del self.users[key]
+                del self.locks[key]
+
+SEQUENCER = KeyedSequencer()
+
 async def on_channel_post(update: Update, context: ContextTypes.DEFAULT_TYPE):
     msg = update.channel_post
     if not msg:
         return
-    if msg.chat_id != SOURCE_CHAT_ID:
-        return
+    await handle_channel_post(context.application, msg)
 
-    key = album_key(msg)
+async def handle_channel_post(app: Application, msg):
+    if not routes_for(msg.chat_id):
+        return
+    STARTUP.first_update()
+    POSTS_RECEIVED.inc()
+    post = post_from_message(msg)
+    if not POSTLOG.record(post):
+        log.info("Dublikat post %s o'tkazib yuborildi.", msg.message_id)
+        return
+    t0 = time.perf_counter()
+    async with SEQUENCER.hold(msg.chat_id):
+        await route_post(app, post)
+    if TRACE_UPDATES:
+        log.info("trace post %s: ingress %.2f ms", msg.message_id, (time.perf_counter() - t0) * 1000)
+
+async def route_post(app: Application, post: PostRecord, routes: Optional[List[Route]] = None):
+    """routes — faqat shu route'lar (replay: PENDING'da kutayotganlari qayta yuborilmaydi)."""
+    key = album_key(post)
     if key:
-        pack = ALBUMS.get(key)
-        if not pack:
-            ALBUMS[key] = {"msgs": [msg]}
-            ALBUMS[key]["task"] = asyncio.create_task(flush_album(context.application, key))
-        else:
-            pack["msgs"].append(msg)
+        add_album_item(app, key, post)
         return
 
-    text = (msg.text or msg.caption or "").strip()
+    dup, entry = dedup_check([post])
+    if dup:
+        await handle_duplicate(app, entry, [post])
+        return
+
+    futs = []
+    for route in routes if routes is not None else routes_for(post.chat_id):
+        fut = await route_single(app, route, post, entry)
+        if fut is not None:
+            futs.append(fut)
+    # manual route'lar bo'lsa WAL'dagi yozuv admin tanlovi ham yetkazilgach ack qilinadi
+    if futs:
+        ack_when_delivered(asyncio.gather(*futs), post)
+
+async def route_single(app: Application, route: Route, post: PostRecord, entry: Optional[dict] = None) -> Optional[asyncio.Future]:
+    """Bitta route uchun: auto -> navbatga qo'yib future qaytaradi; manual -> adminga preview (None)."""
+    text = post.text.strip()
     mode = STATE.get("mode", "auto")
 
+    topic_key = None
+    classified = mode == "auto"
+    if classified:
+        topic_key = classify_topic(text, route)[0]
+        if topic_key is None and STATE.get("low_confidence") == "manual" and ADMIN_IDS:
+            mode = "manual"  # ishonch past -> admin tanlaydi
+
     if mode == "manual":
         if not ADMIN_IDS:
             log.warning("MANUAL rejim: ADMIN_IDS yo‘q, auto fallback.")
             mode = "auto"
         else:
-            PENDING[msg.message_id] = {"msg": msg, "ts": time.time()}
+            pkey = f"{route.idx}:{post.message_id}"
+            for item in PENDING.add(pkey, route.idx, post):
+                auto_route_pending(app, item)
             preview = "📥 Yangi post keldi. Qaysi bo‘limga yuboray?\n\n"
+            if len(ROUTES) > 1:
+                preview = f"📥 Yangi post keldi ({route.name}). Qaysi bo‘limga yuboray?\n\n"
             preview += (text[:500] + ("…" if len(text) > 500 else "")) if text else "(Matn yo‘q, media post)"
 
-            kb = InlineKeyboardMarkup([
-                [InlineKeyboardButton("💬 Umumiy", callback_data=f"pick:{msg.message_id}:umumiy"),
-                 InlineKeyboardButton("🏠 Uy", callback_data=f"pick:{msg.message_id}:uy")],
-                [InlineKeyboardButton("💼 Ish", callback_data=f"pick:{msg.message_id}:ish"),
-                 InlineKeyboardButton("🚖 Taksi", callback_data=f"pick:{msg.message_id}:taksi")],
-                [InlineKeyboardButton("🛂 Visa", callback_data=f"pick:{msg.message_id}:visa"),
-                 InlineKeyboardButton("🛒 Bozor", callback_data=f"pick:{msg.message_id}:bozor")],
-                [InlineKeyboardButton("🕌 Ziyorat", callback_data=f"pick:{msg.message_id}:ziyorat"),
-                 InlineKeyboardButton("🩺 Salomatlik", callback_data=f"pick:{msg.message_id}:salomatlik")],
-                [InlineKeyboardButton("📣 E’lon", callback_data=f"pick:{msg.message_id}:elon")],
-            ])
+            previews = await send_previews(app.bot, preview, topic_picker_kb(route, post.message_id))
+            if previews:
+                if pkey in PENDING:
+                    PENDING.set_previews(pkey, previews)
+                elif pkey in DECIDED:
+                    # boshqa admin preview'lar tarqalguncha tanlab bo'ldi
+                    await close_previews(app.bot, previews, DECIDED[pkey])
+                return None
+            log.warning("Hech bir adminga preview yuborilmadi. Auto fallback.")
+            PENDING.pop(pkey)
+            mode = "auto"
+
+    # classify_topic allaqachon chaqirilgan bo'lsa qayta hisoblamaymiz (statistika ham ikki marta yozilmaydi)
+    topic_key = topic_key or (route.default() if classified else guess_topic_key(text, route))
+    POSTS_ROUTED.inc(topic_key)
+    thread_id = route.thread_id(topic_key)
+    # navbatga qo'yamiz — handler darhol qaytadi, burst silliqlanadi
+    fut = SENDER.submit(
+        route.dest,
+        lambda: send_to_group_with_media(app.bot, route.dest, thread_id, post),
+        f"post {post.message_id} -> {route.name}",
+    )
+    remember_sent(entry, route.idx, thread_id, fut)
+    return fut
+
+Gauge("pending_manual_posts", "Manual rejimda admin tanlovini kutayotgan postlar", lambda: len(PENDING))
+Gauge("send_queue_depth", "Yuborish navbatidagi ishlar", lambda: SENDER.pending())
+Gauge("album_buffer_size", "Yig'ilayotgan albumlar", lambda: len(ALBUMS))
+
+DRAIN_MAX_ROUNDS = 50  # x100 update; qolgani odatdagi polling bilan keladi
+
+async def drain_pending_updates(app: Application) -> tuple:
+    """
+    Deploy paytida Telegram'da to'plangan update'lar: route qilingan kanal postlari ishlanadi,
+    qolganlari (eski /buyruqlar, callback'lar) offset bilan tasdiqlanib tashlanadi.
+    Webhook rejimida getUpdates ishlamaydi — webhook vaqtincha olinadi, run_webhook qayta o'rnatadi.
+    """
+    bot = app.bot
+    if WEBHOOK_URL:
+        await bot.delete_webhook(drop_pending_updates=False)
+    offset, kept, skipped = None, 0, 0
+    for _ in range(DRAIN_MAX_ROUNDS):
+        # allowed_updates berilmaydi: Telegram uni eslab qoladi va run_polling/run_webhook sozlamasini bosib ketadi
+        updates = await bot.get_updates(offset=offset, timeout=0, limit=100)
+        if not updates:
+            break
+        for u in updates:
+            if u.channel_post and routes_for(u.channel_post.chat_id):
+                await handle_channel_post(app, u.channel_post)
+                kept += 1
+            else:
+                skipped += 1
+        offset = updates[-1].update_id + 1
+    return kept, skipped
+
+async def warm_matchers():
+    """Classifier'lar birinchi postni kutmasdan fonda (thread'da) quriladi."""
+    t0 = time.perf_counter()
+    for route in ROUTES:
+        if route._clf is not None:
+            continue
+        kw, weights = route.get_keywords(), route.get_weights()
+        clf = await asyncio.to_thread(KeywordClassifier, kw, weights)
+        if route._clf is None:
+            route._clf = clf
+            route._clf_src = (state_version(), kw, weights)
+    log.info("Matcher tayyor: %.0f ms", (time.perf_counter() - t0) * 1000)
+
+async def on_start(app: Application):
+    app.bot_data["warm_matchers"] = asyncio.create_task(warm_matchers())
+    if METRICS_PORT:
+        app.bot_data["metrics_server"] = await start_metrics_server(METRICS_PORT)
+    POSTLOG.open()
+    PENDING.load(app.bot)
+    if len(PENDING):
+        log.info("PENDING: %s ta post admin tanlovini kutmoqda.", len(PENDING))
+    STARTUP.mark("wal")
+    pending = POSTLOG.pending(app.bot)
+    if pending:
+        log.info("WAL: %s ta yuborilmagan post qayta yuborilmoqda.", len(pending))
+    for post in pending:
+        waiting = pending_routes(post)  # bular PENDING'dan (admin/TTL) yetkaziladi
+        routes = [r for r in routes_for(post.chat_id) if r.idx not in waiting]
+        if routes:
+            await route_post(app, post, routes)
+    STARTUP.mark("replay")
+    try:
+        kept, skipped = await drain_pending_updates(app)
+        if kept or skipped:
+            log.info("Navbatdagi update'lar: %s ta kanal posti ishlandi, %s ta tashlandi.", kept, skipped)
+    except Exception as e:
+        log.warning("Navbatdagi update'larni olib bo'lmadi (polling o'zi oladi): %s", e)
+    STARTUP.mark("drain")
+    app.bot_data["pending_sweeper"] = asyncio.create_task(pending_sweeper(app))
+    app.bot_data["analytics_flusher"] = asyncio.create_task(analytics_flusher())
+    STARTUP.report()
+
+async def on_stop(app: Application):
+    for name in ("pending_sweeper", "analytics_flusher", "warm_matchers"):
+        task = app.bot_data.pop(name, None)
+        if task is not None:
+            task.cancel()
+    server = app.bot_data.pop("metrics_server", None)
+    if server is not None:
+        server.close()
+    await SENDER.drain()
+    flush_state()
+    DECISIONS.flush(POSTLOG.db)
+    POSTLOG.close()
+
+# ============ BACKFILL (Telegram Desktop JSON eksporti) ============
+# python bot.py backfill result.json [--batch 100] [--dry-run]
+# Eksportda file_id yo'q: postlar source kanaldan message_id bo'yicha copy/forward qilinadi
+# (bot kanalda admin bo'lishi kerak). Har batch yuborilgach checkpoint yoziladi.
+BACKFILL_CHUNK = 1 << 20
+
+def _export_text(value) -> str:
+    """Eksportdagi "text": satr yoki [satr | {"type": ..., "text": ...}] ro'yxati."""
+    if isinstance(value, str):
+        return value
+    return "".join(p if isinstance(p, str) else p.get("text", "") for p in value or ())
+
+class ExportReader:
+    """
+    result.json ni butunlay xotiraga yuklamasdan o'qiydi: yuqori darajadagi kalitlar
+    (name/type/id) yig'iladi, "messages" massivi esa bittadan JSONDecoder.raw_decode bilan.
+    """
 
+    def __init__(self, path: str):
+        self.path = path
+        self.meta: dict = {}
+        self._f = None
+        self._buf = ""
+        self._pos = 0
+        self._eof = False
+        self._dec = json.JSONDecoder()
+
+    def _fill(self) -> bool:
+        if self._eof:
+            return False
+        chunk = self._f.read(BACKFILL_CHUNK)
+        if not chunk:
+            self._eof = True
+            return False
+        self._buf = self._buf[self._pos:] + chunk
+        self._pos = 0
+        return True
+
+    def _skip_ws(self) -> str:
+        while True:
+            while self._pos < len(self._buf) and self._buf[self._pos] in " \t\r\n":
+                self._pos += 1
+            if self._pos < len(self._buf):
+                return self._buf[self._pos]
+            if not self._fill():
+                raise ValueError("eksport fayli kutilmaganda tugadi")
+
+    def _expect(self, chars: str) -> str:
+        ch = self._skip_ws()
+        if ch not in chars:
+            raise ValueError(f"eksport formati xato: {ch!r} (kutilgan {chars!r})")
+        self._pos += 1
+        return ch
+
+    def _value(self):
+        self._skip_ws()
+        while True:
             try:
-                await context.bot.send_message(chat_id=ADMIN_IDS[0], text=preview, reply_markup=kb)
-            except Exception as e:
-                log.warning("Admin DM yuborilmadi: %s. Auto fallback.", e)
-                mode = "auto"
+                value, end = self._dec.raw_decode(self._buf, self._pos)
+            except json.JSONDecodeError:
+                if not self._fill():
+                    raise
+                continue
+            # son bufer oxirida tugasa, davomi keyingi chunk'da bo'lishi mumkin
+            if end == len(self._buf) and not self._eof and self._fill():
+                continue
+            self._pos = end
+            return value
+
+    def messages(self):
+        with open(self.path, "r", encoding="utf-8-sig") as self._f:
+            self._expect("{")
+            if self._skip_ws() == "}":
+                return
+            while True:
+                key = self._value()
+                self._expect(":")
+                if key == "messages":
+                    self._expect("[")
+                    if self._skip_ws() == "]":
+                        self._pos += 1
+                    else:
+                        while True:
+                            yield self._value()
+                            if self._expect(",]") == "]":
+                                break
+                else:
+                    self.meta[key] = self._value()
+                if self._expect(",}") == "}":
+                    return
+
+def post_from_export(m: dict, chat_id: int) -> PostRecord:
+    """Eksport yozuvidan PostRecord: media bo'lsa kind="other" (faqat copy_message)."""
+    media = bool(m.get("photo") or m.get("file") or m.get("media_type") or m.get("poll") or m.get("location_information"))
+    credit = m.get("forwarded_from")
+    return PostRecord(
+        chat_id, int(m["id"]), kind="other" if media else None,
+        text=_export_text(m.get("text")), forwarded="forwarded_from" in m, credit=credit or None,
+    )
 
-    if mode == "auto":
-        topic_key = guess_topic_key(text)
-        thread_id = topic_thread_id(topic_key)
-        await send_to_group_with_media(context.bot, DEST_CHAT_ID, thread_id, msg)
+async def backfill(bot, path: str, batch: int = 100, dry_run: bool = False):
+    reader = ExportReader(path)
+    it = reader.messages()
+    first = next(it, None)
+    raw_id = reader.meta.get("id")
+    if raw_id is None:
+        raise RuntimeError("Eksportda kanal id topilmadi (Telegram Desktop -> Export chat history -> JSON).")
+    chat_id = int(f"-100{raw_id}") if int(raw_id) > 0 else int(raw_id)
+    routes = routes_for(chat_id)
+    if not routes:
+        raise RuntimeError(f"{chat_id} ({reader.meta.get('name')}) uchun route yo'q.")
+
+    ckey = f"{chat_id}"
+    start_after = POSTLOG.checkpoint(ckey)
+    retry = POSTLOG.backfill_failed(ckey)  # checkpoint'dan oldingi, avval yuborilmaganlar
+    live_from = POSTLOG.live_start(chat_id)
+    log.info("Backfill: %s -> %s route, checkpoint=%s, live_from=%s, qayta=%s", reader.meta.get("name"), len(routes), start_after, live_from, len(retry))
+    stats = {"sent": 0, "failed": 0, "skipped": 0}
+    routed: Dict[str, int] = {}
+
+    async def flush(posts: List[PostRecord]):
+        futs, sends = [], []
+        for route in routes:
+            for post, topic_key in zip(posts, classify_many([p.text for p in posts], route)):
+                if post.message_id in retry and route.idx not in retry[post.message_id]:
+                    continue  # bu route'ga avvalgi ishga tushishda yetib borgan
+                routed[topic_key] = routed.get(topic_key, 0) + 1
+                if dry_run:
+                    continue
+                POSTS_ROUTED.inc(topic_key)
+                thread_id = route.thread_id(topic_key)
+                futs.append(SENDER.submit(
+                    route.dest,
+                    lambda post=post, route=route, thread_id=thread_id: send_to_group_with_media(bot, route.dest, thread_id, post),
+                    f"backfill {post.message_id} -> {route.name}",
+                ))
+                sends.append((post.message_id, route.idx))
+        failed, done = [], []
+        for send, res in zip(sends, await asyncio.gather(*futs, return_exceptions=True)):
+            if isinstance(res, BaseException):
+                stats["failed"] += 1
+                failed.append(send)
+                log.warning("Backfill: #%s yuborilmadi: %s", send[0], res)
+            else:
+                stats["sent"] += 1
+                if send[0] in retry:
+                    done.append(send)
+        if not dry_run:
+            # checkpoint oldinga siljiydi; yuborilmaganlar alohida yoziladi va keyingi safar qayta urinadi
+            POSTLOG.set_backfill_failed(ckey, failed, done)
+            POSTLOG.set_checkpoint(ckey, max(start_after, posts[-1].message_id))
+        log.info("Backfill: #%s gacha | %s", posts[-1].message_id, stats)
+
+    posts: List[PostRecord] = []
+    for m in itertools.chain((first,) if first is not None else (), it):
+        mid = int(m.get("id", 0))
+        if m.get("type") != "message" or (mid <= start_after and mid not in retry):
+            continue
+        # live_from va undan keyingilarini shu kanal uchun jonli bot yuborgan
+        if live_from and mid >= live_from:
+            stats["skipped"] += 1
+            continue
+        posts.append(post_from_export(m, chat_id))
+        if len(posts) >= batch:
+            await flush(posts)
+            posts = []
+    if posts:
+        await flush(posts)
+    log.info("Backfill tugadi: %s | topiclar: %s", stats, routed)
+    if stats["failed"] and not dry_run:
+        log.warning("Backfill: %s ta yuborish bajarilmadi — qayta ishga tushirilganda yana urinadi.", stats["failed"])
+    return stats
+
+def backfill_main(argv: List[str]):
+    import argparse
+
+    ap = argparse.ArgumentParser(prog="bot.py backfill", description="Kanal tarixini (Telegram Desktop JSON eksporti) guruhga yuborish")
+    ap.add_argument("export", help="result.json")
+    ap.add_argument("--batch", type=int, default=100, help="bir batchdagi postlar (classify + checkpoint)")
+    ap.add_argument("--dry-run", action="store_true", help="faqat topic statistikasi, yubormaydi")
+    args = ap.parse_args(argv)
+
+    if not BOT_TOKEN and not args.dry_run:
+        raise RuntimeError("BOT_TOKEN yo‘q.")
+    load_state()
+    load_routes()
+
+    async def run():
+        POSTLOG.open()
+        try:
+            if args.dry_run:
+                await backfill(None, args.export, max(1, args.batch), dry_run=True)
+                return
+            api = {"base_url": f"{BOT_API_BASE_URL}/bot", "base_file_url": f"{BOT_API_BASE_URL}/file/bot"} if BOT_API_BASE_URL else {}
+            async with Bot(BOT_TOKEN, **api) as bot:
+                await backfill(bot, args.export, max(1, args.batch))
+                await SENDER.drain()
+        finally:
+            POSTLOG.close()
+
+    asyncio.run(run())
 
 def main():
+    if len(sys.argv) > 1 and sys.argv[1] == "backfill":
+        return backfill_main(sys.argv[2:])
     if not BOT_TOKEN:
         raise RuntimeError("BOT_TOKEN yo‘q. Railway Variables’ga BOT_TOKEN qo‘ying.")
-    if not SOURCE_CHAT_ID or not DEST_CHAT_ID:
-        raise RuntimeError("SOURCE_CHAT_ID va DEST_CHAT_ID majburiy.")
+    if not ROUTES_FILE and (not SOURCE_CHAT_ID or not DEST_CHAT_ID):
+        raise RuntimeError("SOURCE_CHAT_ID va DEST_CHAT_ID (yoki ROUTES_FILE) majburiy.")
 
+    STARTUP.mark("import")
     load_state()
-
-    app = Application.builder().token(BOT_TOKEN).build()
+    STARTUP.mark("state")
+    load_routes()
+    for r in ROUTES:
+        log.info("Route %s: %s -> %s (%s ta topic)", r.name, r.source, r.dest, len(r.topics))
+    STARTUP.mark("routes")
+
+    builder = (
+        Application.builder()
+        .token(BOT_TOKEN)
+        .concurrent_updates(CONCURRENT_UPDATES)
+        .post_init(on_start)
+        .post_stop(on_stop)
+    )
+    if BOT_API_BASE_URL:
+        log.info("Bot API: %s", BOT_API_BASE_URL)
+        builder = builder.base_url(f"{BOT_API_BASE_URL}/bot").base_file_url(f"{BOT_API_BASE_URL}/file/bot")
+    app = builder.build()
+    STARTUP.mark("app")
 
     app.add_handler(CommandHandler("start", start_cmd))
     app.add_handler(CommandHandler("admin", admin_cmd))
+    app.add_handler(CommandHandler("kw_add", kw_add_cmd))
+    app.add_handler(CommandHandler("kw_del", kw_del_cmd))
+    app.add_handler(CommandHandler("stats", stats_cmd))
+    app.add_handler(MessageHandler(
+        filters.ChatType.PRIVATE & filters.Document.ALL & filters.CaptionRegex(r"^/kw_import\b"), kw_import_doc
+    ))
     app.add_handler(CallbackQueryHandler(admin_cb, pattern=r"^(adm:|def:|pick:)"))
 
     app.add_handler(MessageHandler(filters.UpdateType.CHANNEL_POST, on_channel_post))
 
     log.info("✅ Channel-to-group bot ishga tushdi. Mode=%s | Default=%s", STATE.get("mode"), STATE.get("default_topic"))
-    app.run_polling(drop_pending_updates=True)
+    # navbatdagi kanal postlarini on_start (drain_pending_updates) oladi; takrorlari WAL'da filtrlanadi
+    if WEBHOOK_URL:
+        app.run_webhook(
+            listen="0.0.0.0",
+            port=PORT,
+            url_path=WEBHOOK_PATH,
+            webhook_url=f"{WEBHOOK_URL}/{WEBHOOK_PATH}",
+            secret_token=WEBHOOK_SECRET,
+            drop_pending_updates=False,
+        )
+    else:
+        app.run_polling(drop_pending_updates=False)
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,146 @@
+"""
+Soxta Bot API'ga (loadtest/fake_api.py) sintetik kanal postlarini yuborib, bot ularni
+guruhga qancha vaqtda va qanchasini yetkazganini o'lchaydi.
+
+    python loadtest/driver.py --api http://127.0.0.1:8081 -n 5000 --rate 200
+
+Post turlari: matn, foto, video, forward va albumlar. Har post matnida noyob marker bor —
+copy/forward bo'lmagan yuborishlarda ham qaysi post yetkazilgani aniqlanadi.
+"""
+import sys
+import time
+import random
+import asyncio
+import argparse
+
+import aiohttp
+
+WORDS = [
+    "hostel", "kvartira", "ijara", "ish", "vakansiya", "maosh", "taksi", "aeroport", "narx",
+    "viza", "iqoma", "sotiladi", "arzon", "umra", "ziyorat", "makka", "doktor", "dori", "diqqat",
+    "assalomu", "alaykum", "bugun", "ertaga", "kerak", "bor", "qancha", "iltimos", "aka", "opa",
+]
+
+
+class PostFactory:
+    def __init__(self, chat_id: int, seed: int = 1):
+        self.chat_id = chat_id
+        self.rnd = random.Random(seed)
+        self.msg_id = 0
+        self.group_id = 0
+        self.user_id = 10**6
+
+    def _text(self, lo=3, hi=40) -> str:
+        return " ".join(self.rnd.choice(WORDS) for _ in range(self.rnd.randint(lo, hi)))
+
+    def _base(self, **extra) -> dict:
+        self.msg_id += 1
+        d = {
+            "message_id": self.msg_id,
+            "date": int(time.time()),
+            "chat": {"id": self.chat_id, "type": "channel", "title": "Source"},
+            "_marker": f"#lt{self.msg_id}",
+        }
+        d.update(extra)
+        return d
+
+    def _media(self, kind: str) -> dict:
+        uid = f"{kind}{self.msg_id}"
+        if kind == "photo":
+            return {"photo": [{"file_id": uid, "file_unique_id": uid, "width": 1280, "height": 960}]}
+        return {"video": {"file_id": uid, "file_unique_id": uid, "width": 1280, "height": 720, "duration": 10}}
+
+    def _with_marker(self, d: dict, field: str) -> dict:
+        d[field] = f"{d.get(field) or ''} {d['_marker']}".strip()
+        return d
+
+    def text(self) -> list:
+        return [self._with_marker(self._base(text=self._text()), "text")]
+
+    def photo(self) -> list:
+        d = self._base(**self._media("photo"))
+        d["caption"] = self._text(1, 25)
+        return [self._with_marker(d, "caption")]
+
+    def video(self) -> list:
+        d = self._base(**self._media("video"))
+        d["caption"] = self._text(1, 25)
+        return [self._with_marker(d, "caption")]
+
+    def forwarded(self) -> list:
+        self.user_id += 1
+        user = {"id": self.user_id, "is_bot": False, "first_name": "U", "username": f"user{self.user_id % 50}"}
+        d = self._base(text=self._text())
+        d["forward_origin"] = {"type": "user", "date": d["date"], "sender_user": user}
+        return [self._with_marker(d, "text")]
+
+    def album(self) -> list:
+        self.group_id += 1
+        posts = []
+        for i in range(self.rnd.randint(2, 10)):
+            d = self._base(media_group_id=f"g{self.group_id}", **self._media(self.rnd.choice(("photo", "video"))))
+            if i == 0:
+                d["caption"] = self._text(1, 25)
+            posts.append(self._with_marker(d, "caption"))
+        return posts
+
+    def next(self) -> list:
+        kind = self.rnd.choices(("text", "photo", "video", "forwarded", "album"), (5, 3, 1, 1, 1))[0]
+        return getattr(self, kind)()
+
+
+async def run(api: str, chat_id: int, n: int, rate: float, settle: float, seed: int) -> dict:
+    factory = PostFactory(chat_id, seed)
+    async with aiohttp.ClientSession() as http:
+        await http.post(f"{api}/_reset")
+        sent = 0
+        t0 = time.monotonic()
+        while sent < n:
+            posts = factory.next()
+            await http.post(f"{api}/_inject", json={"posts": posts})
+            sent += len(posts)
+            if rate > 0:
+                # rejadagi vaqtga yetib olamiz (sleep aniqligi jamlanmaydi)
+                delay = t0 + sent / rate - time.monotonic()
+                if delay > 0:
+                    await asyncio.sleep(delay)
+        inject_sec = time.monotonic() - t0
+
+        # yetkazilishi to'xtaguncha (settle soniya o'zgarishsiz) kutamiz
+        last, idle_since = -1, time.monotonic()
+        while True:
+            async with http.get(f"{api}/_report") as r:
+                report = await r.json()
+            if report["delivered"] != last:
+                last, idle_since = report["delivered"], time.monotonic()
+            elif report["lost"] == 0 or time.monotonic() - idle_since >= settle:
+                break
+            await asyncio.sleep(0.5)
+    report["inject_sec"] = inject_sec
+    report["total_sec"] = time.monotonic() - t0
+    return report
+
+
+def main(argv=None):
+    ap = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    ap.add_argument("--api", default="http://127.0.0.1:8081", help="fake_api manzili")
+    ap.add_argument("--chat", type=int, default=-1001000000001, help="source kanal id (SOURCE_CHAT_ID)")
+    ap.add_argument("-n", type=int, default=2000, help="kanal postlari soni (album elementlari alohida)")
+    ap.add_argument("--rate", type=float, default=100.0, help="post/s (0 = imkon qadar tez)")
+    ap.add_argument("--settle", type=float, default=15.0, help="yetkazish to'xtagach kutish (s)")
+    ap.add_argument("--seed", type=int, default=1)
+    args = ap.parse_args(argv)
+
+    r = asyncio.run(run(args.api.rstrip("/"), args.chat, args.n, args.rate, args.settle, args.seed))
+    lat = r["latency_ms"]
+    print(f"injected  {r['injected']:>8}   ({r['inject_sec']:.1f} s)")
+    print(f"delivered {r['delivered']:>8}   ({r['total_sec']:.1f} s)")
+    print(f"lost      {r['lost']:>8}   ({(r['lost'] / r['injected'] * 100) if r['injected'] else 0:.2f}%)")
+    print(f"latency   p50 {lat['p50']:.0f} ms | p95 {lat['p95']:.0f} ms | p99 {lat['p99']:.0f} ms | max {lat['max']:.0f} ms")
+    print(f"faults    {r['faults']}")
+    print("calls     " + ", ".join(f"{k}={v}" for k, v in sorted(r["calls"].items())))
+    return 1 if r["lost"] else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
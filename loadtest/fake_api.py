@@ -0,0 +1,274 @@
+"""
+Lokal soxta Bot API (aiohttp): botni haqiqiy Telegram'siz yuklama ostida sinash uchun.
+
+    python loadtest/fake_api.py --port 8081 --latency 0.05 --retry-after-rate 0.01 --thread-missing-rate 0.01
+
+    BOT_TOKEN=123:TEST BOT_API_BASE_URL=http://127.0.0.1:8081 \\
+    SOURCE_CHAT_ID=-1001000000001 DEST_CHAT_ID=-1001000000002 SEND_RATE_PER_MIN=0 python bot.py
+
+    python loadtest/driver.py --api http://127.0.0.1:8081 -n 5000
+
+Bot API: getMe, deleteWebhook, getUpdates (long polling), sendMessage, sendPhoto/Video/...,
+sendMediaGroup, forwardMessage(s), copyMessage(s), editMessageText, answerCallbackQuery.
+Boshqa metodlar {"ok": true, "result": true} qaytaradi.
+Driver uchun: POST /_inject (channel_post'lar navbatga), GET /_report (kechikish va yo'qotish).
+Har yuborishda RetryAfter (429) yoki "message thread not found" (400) ehtimol bilan qaytariladi.
+"""
+import json
+import time
+import random
+import asyncio
+import argparse
+from typing import Dict, List, Optional
+
+from aiohttp import web
+
+SEND_METHODS = {
+    "sendMessage", "sendPhoto", "sendVideo", "sendAnimation", "sendDocument", "sendVoice", "sendAudio",
+    "sendMediaGroup", "forwardMessage", "forwardMessages", "copyMessage", "copyMessages",
+}
+
+
+def _param(value: str):
+    """PTB parametrlarni form sifatida yuboradi: murakkablari JSON, satrlar xom holda."""
+    try:
+        return json.loads(value)
+    except ValueError:
+        return value
+
+
+class FakeTelegram:
+    def __init__(self, latency: float = 0.0, jitter: float = 0.5, retry_after_rate: float = 0.0,
+                 retry_after: int = 1, thread_missing_rate: float = 0.0, seed: Optional[int] = None):
+        self.latency = latency
+        self.jitter = jitter
+        self.retry_after_rate = retry_after_rate
+        self.retry_after = retry_after
+        self.thread_missing_rate = thread_missing_rate
+        self.rnd = random.Random(seed)
+
+        self.updates: List[dict] = []
+        self.update_id = 0
+        self.new_update = asyncio.Event()
+        self.message_id = 0
+
+        # driver hisobi: source (chat_id, message_id) -> vaqtlar
+        self.injected: Dict[tuple, float] = {}
+        self.delivered: Dict[tuple, float] = {}
+        self.markers: Dict[str, tuple] = {}
+        self.calls: Dict[str, int] = {}
+        self.faults = {"retry_after": 0, "thread_not_found": 0}
+
+    # ---- yordamchilar ----
+    def _next_message(self, chat_id, thread_id=None, **extra) -> dict:
+        self.message_id += 1
+        msg = {
+            "message_id": self.message_id,
+            "date": int(time.time()),
+            "chat": {"id": int(chat_id), "type": "supergroup", "title": "Dest", "is_forum": True},
+        }
+        if thread_id:
+            msg["message_thread_id"] = int(thread_id)
+            msg["is_topic_message"] = True
+        msg.update(extra)
+        return msg
+
+    def _delivered(self, params: dict, *, source_ids=(), texts=()):
+        """Source postni birinchi yetkazilgan vaqti bilan belgilaydi (copy/forward id, boshqalari marker)."""
+        now = time.monotonic()
+        keys = []
+        from_chat = params.get("from_chat_id")
+        if from_chat is not None:
+            keys += [(int(from_chat), int(mid)) for mid in source_ids]
+        for text in texts:
+            for word in str(text or "").split():
+                if word in self.markers:
+                    keys.append(self.markers[word])
+        for key in keys:
+            if key in self.injected and key not in self.delivered:
+                self.delivered[key] = now
+
+    def _fault(self, params: dict) -> Optional[web.Response]:
+        r = self.rnd.random()
+        if r < self.retry_after_rate:
+            self.faults["retry_after"] += 1
+            return web.json_response({
+                "ok": False, "error_code": 429,
+                "description": f"Too Many Requests: retry after {self.retry_after}",
+                "parameters": {"retry_after": self.retry_after},
+            }, status=429)
+        if params.get("message_thread_id") and r < self.retry_after_rate + self.thread_missing_rate:
+            self.faults["thread_not_found"] += 1
+            return web.json_response(
+                {"ok": False, "error_code": 400, "description": "Bad Request: message thread not found"}, status=400
+            )
+        return None
+
+    # ---- Bot API ----
+    async def bot_api(self, request: web.Request) -> web.Response:
+        method = request.match_info["method"]
+        params = {k: _param(v) for k, v in (await request.post()).items() if isinstance(v, str)}
+        self.calls[method] = self.calls.get(method, 0) + 1
+
+        if method == "getUpdates":
+            return web.json_response({"ok": True, "result": await self.get_updates(params)})
+
+        if self.latency:
+            await asyncio.sleep(max(0.0, self.rnd.gauss(self.latency, self.latency * self.jitter)))
+        if method in SEND_METHODS:
+            fault = self._fault(params)
+            if fault is not None:
+                return fault
+
+        handler = getattr(self, f"m_{method}", None)
+        result = handler(params) if handler else True
+        return web.json_response({"ok": True, "result": result})
+
+    async def get_updates(self, params: dict) -> List[dict]:
+        offset = int(params.get("offset") or 0)
+        if offset:
+            self.updates = [u for u in self.updates if u["update_id"] >= offset]
+        if not self.updates:
+            self.new_update.clear()
+            try:
+                await asyncio.wait_for(self.new_update.wait(), float(params.get("timeout") or 0))
+            except asyncio.TimeoutError:
+                pass
+        return self.updates[: int(params.get("limit") or 100)]
+
+    def m_getMe(self, params):
+        return {"id": 123, "is_bot": True, "first_name": "Fake", "username": "fake_bot",
+                "can_join_groups": True, "can_read_all_group_messages": False, "supports_inline_queries": False}
+
+    def m_sendMessage(self, params):
+        self._delivered(params, texts=[params.get("text")])
+        return self._next_message(params["chat_id"], params.get("message_thread_id"), text=str(params.get("text")))
+
+    def _send_media(self, params, kind: str):
+        self._delivered(params, texts=[params.get("caption")])
+        media = {"file_id": str(params.get(kind)), "file_unique_id": str(params.get(kind))}
+        if kind == "photo":
+            media = [dict(media, width=1280, height=960)]
+        elif kind in ("video", "animation"):
+            media.update(width=1280, height=720, duration=10)
+        elif kind in ("voice", "audio"):
+            media["duration"] = 10
+        extra = {kind: media}
+        if params.get("caption"):
+            extra["caption"] = str(params["caption"])
+        return self._next_message(params["chat_id"], params.get("message_thread_id"), **extra)
+
+    def m_sendPhoto(self, params):
+        return self._send_media(params, "photo")
+
+    def m_sendVideo(self, params):
+        return self._send_media(params, "video")
+
+    def m_sendAnimation(self, params):
+        return self._send_media(params, "animation")
+
+    def m_sendDocument(self, params):
+        return self._send_media(params, "document")
+
+    def m_sendVoice(self, params):
+        return self._send_media(params, "voice")
+
+    def m_sendAudio(self, params):
+        return self._send_media(params, "audio")
+
+    def m_sendMediaGroup(self, params):
+        media = params.get("media") or []
+        self._delivered(params, texts=[m.get("caption") for m in media])
+        return [
+            self._send_media({"chat_id": params["chat_id"], "message_thread_id": params.get("message_thread_id"),
+                              m.get("type", "photo"): m.get("media")}, m.get("type", "photo"))
+            for m in media
+        ]
+
+    def m_forwardMessage(self, params):
+        self._delivered(params, source_ids=[params["message_id"]])
+        return self._next_message(params["chat_id"], params.get("message_thread_id"), text="(forward)")
+
+    def m_forwardMessages(self, params):
+        self._delivered(params, source_ids=params.get("message_ids") or [])
+        return [{"message_id": self._next_message(params["chat_id"])["message_id"]} for _ in params.get("message_ids") or []]
+
+    def m_copyMessage(self, params):
+        self._delivered(params, source_ids=[params["message_id"]])
+        return {"message_id": self._next_message(params["chat_id"])["message_id"]}
+
+    def m_copyMessages(self, params):
+        return self.m_forwardMessages(params)
+
+    def m_editMessageText(self, params):
+        return self._next_message(params.get("chat_id") or 0, text=str(params.get("text")))
+
+    # ---- driver ----
+    async def inject(self, request: web.Request) -> web.Response:
+        """{"posts": [channel_post, ...]} — har biri update sifatida getUpdates navbatiga qo'yiladi."""
+        body = await request.json()
+        now = time.monotonic()
+        for post in body.get("posts") or []:
+            key = (int(post["chat"]["id"]), int(post["message_id"]))
+            self.injected[key] = now
+            marker = post.get("_marker")
+            if marker:
+                self.markers[marker] = key
+            post = {k: v for k, v in post.items() if not k.startswith("_")}
+            self.update_id += 1
+            self.updates.append({"update_id": self.update_id, "channel_post": post})
+        self.new_update.set()
+        return web.json_response({"ok": True, "queued": len(self.updates)})
+
+    async def report(self, request: web.Request) -> web.Response:
+        lat = sorted(self.delivered[k] - self.injected[k] for k in self.delivered)
+
+        def pct(p):
+            return lat[min(len(lat) - 1, int(len(lat) * p))] * 1000 if lat else 0.0
+
+        return web.json_response({
+            "injected": len(self.injected),
+            "delivered": len(self.delivered),
+            "lost": len(self.injected) - len(self.delivered),
+            "pending_updates": len(self.updates),
+            "latency_ms": {"p50": pct(0.50), "p95": pct(0.95), "p99": pct(0.99), "max": lat[-1] * 1000 if lat else 0.0},
+            "faults": self.faults,
+            "calls": self.calls,
+        })
+
+    async def reset(self, request: web.Request) -> web.Response:
+        self.injected.clear()
+        self.delivered.clear()
+        self.markers.clear()
+        self.calls.clear()
+        self.faults = {"retry_after": 0, "thread_not_found": 0}
+        return web.json_response({"ok": True})
+
+
+def make_app(api: FakeTelegram) -> web.Application:
+    app = web.Application(client_max_size=64 * 1024 * 1024)
+    app.router.add_route("*", "/bot{token}/{method}", api.bot_api)
+    app.router.add_post("/_inject", api.inject)
+    app.router.add_get("/_report", api.report)
+    app.router.add_post("/_reset", api.reset)
+    return app
+
+
+def main(argv=None):
+    ap = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    ap.add_argument("--host", default="127.0.0.1")
+    ap.add_argument("--port", type=int, default=8081)
+    ap.add_argument("--latency", type=float, default=0.0, help="o'rtacha javob kechikishi (s)")
+    ap.add_argument("--jitter", type=float, default=0.5, help="kechikish tarqalishi (latency ga nisbatan)")
+    ap.add_argument("--retry-after-rate", type=float, default=0.0, help="yuborishlarning shu ulushiga 429")
+    ap.add_argument("--retry-after", type=int, default=1, help="429 dagi retry_after (s)")
+    ap.add_argument("--thread-missing-rate", type=float, default=0.0, help="thread'li yuborishlarga 'thread not found'")
+    ap.add_argument("--seed", type=int, default=None)
+    args = ap.parse_args(argv)
+
+    api = FakeTelegram(args.latency, args.jitter, args.retry_after_rate, args.retry_after, args.thread_missing_rate, args.seed)
+    web.run_app(make_app(api), host=args.host, port=args.port)
+
+
+if __name__ == "__main__":
+    main()